@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+#
+# An on-disk cache of decoded FCS files
+import os
+import hashlib
+import tempfile
+import cPickle as pickle
+import numpy as np
+import fcs
+
+class FCSCache:
+    """ Stores the decoded channel matrix of FCS files as native-endian,
+        channel-contiguous .npy files alongside their parsed metadata, so that
+        later reads skip parsing, byte swapping and transposing and can memory
+        map the matrix directly.
+
+        Entries are keyed by the path, size and modification time of the FCS
+        file and a hash of its HEADER and TEXT segments.  When the total size
+        of the cache exceeds max_bytes, the least recently used entries are
+        removed.
+
+        To have every FlowData use a cache, set
+            FlowData.cache = FCSCache()
+    """
+    def __init__(self, directory = None, max_bytes = 10*2**30):
+        if directory is None:
+            directory = os.environ.get('SPICE_CACHE',
+                    os.path.join(os.path.expanduser('~'), '.cache', 'spice'))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def _key(self, filename):
+        path = os.path.abspath(filename)
+        st = os.stat(path)
+        h = hashlib.sha1()
+        h.update('{}\0{}\0{!r}\0'.format(path, st.st_size, st.st_mtime))
+        with open(path, 'rb') as f:
+            (fcs_type, offsets) = fcs._read_header(f)
+            (text_start, text_stop) = offsets[:2]
+            f.seek(0)
+            h.update(f.read(58))
+            f.seek(text_start)
+            h.update(f.read(text_stop - text_start + 1))
+        return h.hexdigest()
+
+    def read(self, filename, mmap = True):
+        """ Returns the same tuple as fcs.read(filename), reading it from the
+            cache if present and adding it otherwise.
+
+            mmap - return the channel matrix as a read-only memory map of the
+                cached .npy file rather than reading it into memory.
+        """
+        key = self._key(filename)
+        data_path = os.path.join(self.directory, key + '.npy')
+        meta_path = os.path.join(self.directory, key + '.pkl')
+
+        if os.path.isfile(data_path) and os.path.isfile(meta_path):
+            with open(meta_path, 'rb') as f:
+                (metadata, analysis, meta_analysis) = pickle.load(f)
+            # Mark this entry as recently used
+            os.utime(data_path, None)
+        else:
+            (data, metadata, analysis, meta_analysis) = fcs.read(filename, True)
+            data = np.ascontiguousarray(data, dtype = data.dtype.newbyteorder('='))
+            # Write under temporary names and rename, so concurrent readers
+            # never see a partial entry
+            self._write(data_path, lambda f: np.save(f, data))
+            self._write(meta_path, lambda f: pickle.dump((metadata, analysis, meta_analysis), f, -1))
+            self.evict()
+            # The new entry may itself have been too large to keep
+            if not mmap or not os.path.isfile(data_path):
+                return (data, metadata, analysis, meta_analysis)
+
+        data = np.load(data_path, mmap_mode = 'r' if mmap else None)
+        return (data, metadata, analysis, meta_analysis)
+
+    def _write(self, path, write):
+        (fd, tmp) = tempfile.mkstemp(dir = self.directory, suffix = '.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.rename(tmp, path)
+        except:
+            os.remove(tmp)
+            raise
+
+    def evict(self):
+        """ Removes least recently used entries until the cache fits in max_bytes."""
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npy'):
+                continue
+            data_path = os.path.join(self.directory, name)
+            meta_path = data_path[:-4] + '.pkl'
+            try:
+                st = os.stat(data_path)
+                size = st.st_size
+                if os.path.isfile(meta_path):
+                    size += os.path.getsize(meta_path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, size, data_path, meta_path))
+            total += size
+
+        entries.sort()
+        for (mtime, size, data_path, meta_path) in entries:
+            if total <= self.max_bytes:
+                break
+            for path in (data_path, meta_path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+
+    def clear(self):
+        """ Removes every entry from the cache."""
+        for name in os.listdir(self.directory):
+            if name.endswith('.npy') or name.endswith('.pkl'):
+                os.remove(os.path.join(self.directory, name))
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+#
+# Catalog the metadata of a directory tree of FCS files
+import os
+import json
+import fcs
+
+def _decode(s):
+    """ s as unicode, so it can be written as JSON; TEXT segments and paths
+        are often not UTF-8, so bytes that do not decode as UTF-8 are read 
+        as latin-1.
+    """
+    if not isinstance(s, str):
+        return s
+    try:
+        return s.decode('utf-8')
+    except UnicodeDecodeError:
+        return s.decode('latin-1')
+
+def scan(directory, index = None, extension = '.fcs'):
+    """
+        Walks directory and returns a dictionary mapping the path of every FCS
+        file found to its TEXT segment metadata (see fcs.read_metadata).
+        Only the HEADER and TEXT segments of each file are read.
+
+        index - path of a JSON file used to store the metadata between scans.
+            An entry is reused as long as the file's modification time and
+            size are unchanged, so rescanning an archive only reads new or
+            modified files.  Entries for files that no longer exist are dropped.
+            Keywords and values are stored, and returned, as unicode.
+
+        extension - only files ending with this (case insensitive) are read
+    """
+    entries = {}
+    if index is not None and os.path.isfile(index):
+        with open(index, 'r') as f:
+            entries = json.load(f)
+
+    catalog = {}
+    updated = {}
+    for (root, dirs, files) in os.walk(directory):
+        for name in files:
+            if not name.lower().endswith(extension.lower()):
+                continue
+            path = os.path.abspath(os.path.join(root, name))
+            key = _decode(path)
+            entry = entries.get(key)
+            try:
+                st = os.stat(path)
+                if entry is None or entry['mtime'] != st.st_mtime or entry['size'] != st.st_size:
+                    metadata = fcs.read_metadata(path, convert_metadata = False)
+                    metadata = dict((_decode(k), _decode(v)) for (k, v) in metadata.items())
+                    entry = {'mtime': st.st_mtime, 'size': st.st_size, 'metadata': metadata}
+            except Exception:
+                # Not a readable FCS file, or removed during the scan; leave
+                # it out of the catalog
+                continue
+            updated[key] = entry
+            catalog[path] = fcs._convert_metadata(dict(entry['metadata']))
+
+    if index is not None and updated != entries:
+        # Write to a temporary file first so an interrupted scan cannot
+        # leave a truncated index behind
+        tmp = index + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(updated, f)
+        os.rename(tmp, index)
+
+    return catalog
@@ -3,6 +3,7 @@
 #
 # Library for reading and writing FCS files
 import re
+from collections import namedtuple
 import numpy as np
 
 debug = False
@@ -13,18 +14,13 @@ if debug:
 
 # TODO: remove error text message and replace with raising exceptions
 
-def read(filename, convert_metadata = True):
+def _read_header(f):
     """
-        Reads in an FCS file, given by filename and returns a tuple containing
-        a numpy array and a dictionary of data.
-
-        convert_metadata - convert the metadata into python appropreate types
-            i.e., the string '15' becomes the integer 15
-
-        Based on Laszlo Balkay's fca_readfcs.m from 3 Dec 2013.
+        Reads the HEADER segment from the open file f, returning the FCS
+        version string and a tuple of segment offsets
+            (text_start, text_stop, data_start, data_stop, analysis_start, analysis_stop)
+        where the analysis offsets are None if not present.
     """
-    f = open(filename, 'r')
-
     # Read the header information
     first_line = f.read(64)
     fcs_type = first_line[0:6]
@@ -33,12 +29,10 @@ def read(filename, convert_metadata = True):
         print fcs_type
 
     if fcs_type == 'FCS1.0':
-        f.close()
         raise Exception("Cannot read FCS1.0 Files")
     elif fcs_type == 'FCS2.0' or fcs_type == 'FCS3.0' or fcs_type == 'FCS3.1':
         pass
     else:
-        f.close()
         raise Exception('Error: File type {} not understood'.format(fcs_type)) 
 
     header_start = int(first_line[10:18])
@@ -52,43 +46,136 @@ def read(filename, convert_metadata = True):
     except ValueError:
         analysis_start = None
         analysis_stop = None
-    
+
+    return (fcs_type, (header_start, header_stop, data_start, data_stop,
+            analysis_start, analysis_stop))
+
+def _read_text(f, header_start, header_stop):
+    """
+        Reads the TEXT segment between the given offsets of the open file f
+        into a dictionary of (unconverted) keyword strings.
+    """
     ############################################################################
     # Read in the TEXT section
     ############################################################################
     status = f.seek(header_start)
     header = f.read(header_stop - header_start + 1)
 
-    # The first character of the primary text segments contains the delimiter
-    # We use re.escape to escape possible problem characters, e.g., [\*$^]
-    delimiter = re.escape(header[0])
-    
-    # Now read in the metadata from the header into a dictionary
-    # This pattern matches slashes: pattern = re.compile(r"/([^/]+)/([^/]*)(?=/[^/]+/|$)")
-    # See: http://stackoverflow.com/questions/10380992/get-python-dictionary-from-string-containing-key-value-pairs
-    # Match strings between delimiters and end with either end of file or a final delimiter
-    pattern = re.compile(delimiter+r"([^"+delimiter+r"]+)"+delimiter+r"([^"+delimiter+r"]*)(?="+delimiter+"|$)")
-    m = re.match(pattern,header)
-    metadata = dict(pattern.findall(header))
-    
+    return _parse_text(header)
 
-    # TODO Include special code for reading in compensation matrices
-    # NOTE Rather than following Balkay's approach, we keep all key-value pairs 
-    #     from the TEXT section in a dictionary.
-    
-    ############################################################################
-    # Read in the DATA section
-    ############################################################################
-    f.seek(data_start)
-    n_events = int(metadata['$TOT'])
-    n_parameters = int(metadata['$PAR'])
-    
-    if debug:
-        print "# events: %d; # parameters %d" % (n_events,n_parameters)
-        pp = pprint.PrettyPrinter(indent = 4)
-        pp.pprint(metadata)
+def _parse_text(text):
+    """
+        Splits a TEXT segment into a dictionary of keyword strings in a single
+        pass.  The first character is the delimiter; a doubled delimiter 
+        inside a value stands for the delimiter itself.  Instruments write
+        empty values (e.g., /$P1S//$P1N/FSC/), so a doubled delimiter after a
+        keyword ends the keyword and starts an empty value.  Standard
+        ($-prefixed) keywords are case insensitive and are stored upper case.
+    """
+    delimiter = text[0]
+    n = len(text)
+    fields = []
+    start = 1
+    while start < n:
+        parts = []
+        i = start
+        value = len(fields) % 2 == 1
+        while True:
+            j = text.find(delimiter, i)
+            if j == -1:
+                j = n
+            if value and j + 1 < n and text[j+1] == delimiter:
+                # Escaped delimiter; keep one copy and continue the field
+                parts.append(text[i:j+1])
+                i = j + 2
+            else:
+                parts.append(text[i:j])
+                break
+        fields.append(''.join(parts))
+        start = j + 1
+
+    metadata = {}
+    for (key, value) in zip(fields[0::2], fields[1::2]):
+        if key.startswith('$'):
+            key = key.upper()
+        metadata[key] = value
+    return metadata
+
+# Keywords converted by _convert_metadata
+_int_keywords = re.compile(r'\$(TOT|PAR|NEXTDATA|BEGIN[A-Z]+|END[A-Z]+|P\d+B|P\d+R)$')
+_float_keywords = re.compile(r'\$(TIMESTEP|P\d+G|P\d+V)$')
+_tuple_keywords = re.compile(r'\$(P\d+E|G\d+E)$')
+
+def _convert_metadata(metadata):
+    """
+        Converts the numeric keyword strings in metadata into python types
+        in place: counts, offsets, $PnB and $PnR become ints; gains, voltages
+        and $TIMESTEP floats; and $PnE a tuple of floats.  Values that do not
+        parse (e.g., $PnB = '*') are left as strings.
+    """
+    for (key, value) in metadata.items():
+        if not isinstance(value, basestring):
+            continue
+        try:
+            if _int_keywords.match(key):
+                metadata[key] = int(float(value))
+            elif _float_keywords.match(key):
+                metadata[key] = float(value)
+            elif _tuple_keywords.match(key):
+                metadata[key] = tuple(float(x) for x in value.split(','))
+        except ValueError:
+            pass
+    return metadata
+
+# One row of the table returned by channels
+Channel = namedtuple('Channel', ['name', 'marker', 'bits', 'range', 'gain', 'amplification'])
+
+def channels(metadata):
+    """
+        Returns a list with a Channel for each parameter collecting its $PnN,
+        $PnS, $PnB, $PnR, $PnG and $PnE keywords.  Missing keywords are given
+        as '' for names, None for numbers, and gain defaults to 1.0.
+    """
+    table = []
+    for j in range(int(metadata['$PAR'])):
+        get = lambda k, default = None: metadata.get('$P{}{}'.format(j+1, k), default)
+        table.append(Channel(get('N', ''), get('S', ''), get('B'), get('R'), 
+                get('G', 1.0), get('E')))
+    return table
+
+def spillover(metadata):
+    """
+        Returns the spillover matrix in the TEXT segment as a tuple 
+        (names, matrix), where matrix[i,j] is the fraction of the signal of
+        channel names[i] detected in channel names[j], or None if there is none.
+
+        The FCS 3.1 $SPILLOVER keyword is used, falling back to the $SPILL and
+        SPILL keywords written by older software and finally to the FCS 3.0 
+        $COMP matrix, which applies to the first n channels.
+    """
+    for key in ['$SPILLOVER', '$SPILL', 'SPILL', '$COMP']:
+        if key in metadata:
+            break
+    else:
+        return None
 
+    fields = [x.strip() for x in str(metadata[key]).split(',')]
+    n = int(fields[0])
+    if key == '$COMP':
+        names = [metadata.get('$P{}N'.format(j+1), '') for j in range(n)]
+        values = fields[1:]
+    else:
+        names = fields[1:n+1]
+        values = fields[n+1:]
+    if len(values) != n*n:
+        raise Exception('Error: {} does not contain a {} by {} matrix'.format(key, n, n))
+    return (names, np.array([float(x) for x in values]).reshape(n, n))
 
+def _data_types(metadata):
+    """
+        Returns a list of the numpy dtypes (with byte order) used in the DATA
+        segment; this contains a single entry if all channels share a type.
+    """
     # Types of Data: doubles, floats, and ints
     # We create a list for the case of 
     data_type = []
@@ -97,16 +184,13 @@ def read(filename, convert_metadata = True):
     elif metadata['$DATATYPE'].lower() == 'f':
         data_type.append(np.dtype('float32'))
     elif metadata['$DATATYPE'].lower() == 'i':
-        for j in range(0,n_parameters):
+        for j in range(0,int(metadata['$PAR'])):
             key = "$P{:d}B".format(j+1)
             bits = int(metadata[key])
-            if bits == 16 or bits == 32 or bits == 64:
+            if bits == 8 or bits == 16 or bits == 32 or bits == 64:
                 data_type.append(np.dtype('uint{:d}'.format(bits)))
             else:
-                raise Exception("Incompatable number of bits in channel {:d}, only allow 16, 32, or 64 bit data".format(bits))
-
-    if debug:
-        print data_type
+                raise Exception("Incompatable number of bits in channel {:d}, only allow 8, 16, 32, or 64 bit data".format(bits))
 
     # Now factor in endian-ness
     if metadata['$BYTEORD'] == '1,2,3,4':
@@ -125,20 +209,167 @@ def read(filename, convert_metadata = True):
     elif metadata['$MODE'].lower() != 'l':
         raise Exception("Mode not understood")
     
-    # Read in data
     # For interger types, we allow a bit length dependent on the channel; first, check if we 
     # only have one type
     if all(x == data_type[0] for x in data_type):
         data_type = [data_type[0]]
+    return data_type
 
+def _range_masks(metadata, data_type):
+    """
+        Returns a list with the bit mask implied by $PnR for each integer 
+        channel (None where no bits need clearing), or None if no channel 
+        needs masking.  The standard requires values of an integer channel
+        with range R to be masked to the ceil(log2(R)) low bits.
+    """
+    if metadata['$DATATYPE'].lower() != 'i':
+        return None
+    n_parameters = int(metadata['$PAR'])
+    masks = []
+    for j in range(n_parameters):
+        bits = 8*data_type[min(j, len(data_type)-1)].itemsize
+        try:
+            r = int(float(metadata['$P{}R'.format(j+1)]))
+        except (KeyError, ValueError):
+            r = 0
+        if r > 1 and int(np.ceil(np.log2(r))) < bits:
+            masks.append((1 << int(np.ceil(np.log2(r)))) - 1)
+        else:
+            masks.append(None)
+    if all(m is None for m in masks):
+        return None
+    return masks
+
+def _apply_masks(data, masks):
+    """ Applies the masks from _range_masks in place to the rows of data."""
+    if masks is None:
+        return
+    for (j, mask) in enumerate(masks):
+        if mask is not None:
+            np.bitwise_and(data[j], mask, out = data[j])
+
+def _event_dtype(data_type, n_parameters):
+    """
+        Returns the dtype of a single event (one value per channel) given the 
+        list of channel types from _data_types.
+    """
     if len(data_type) == 1:
+        return np.dtype((data_type[0], (n_parameters,)))
+    return np.dtype([('P{}'.format(j+1), x) for (j, x) in enumerate(data_type)])
+
+def _decode_events(events, data_type, masks = None):
+    """
+        Converts an array of events of _event_dtype into a native-endian array
+        of shape (n_parameters, n_events), applying the masks from _range_masks.
+        Channels of differing integer widths are decoded into float32.
+    """
+    if len(data_type) == 1:
+        data = np.ascontiguousarray(events.T, dtype = data_type[0].newbyteorder('='))
+        _apply_masks(data, masks)
+        return data
+
+    data = np.empty((len(data_type), len(events)), dtype = np.float32)
+    for (j, name) in enumerate(events.dtype.names):
+        if masks is not None and masks[j] is not None:
+            data[j] = np.bitwise_and(events[name], masks[j])
+        else:
+            data[j] = events[name]
+    return data
+
+def _data_offset(data_start, metadata):
+    """ Returns the offset of the DATA segment given the offset in the HEADER."""
+    # Offsets beyond 99,999,999 bytes do not fit in the HEADER and are only
+    # given in the TEXT segment
+    if data_start == 0 and '$BEGINDATA' in metadata:
+        data_start = int(metadata['$BEGINDATA'])
+    return data_start
+
+def read_metadata(filename, convert_metadata = True):
+    """
+        Reads only the HEADER and TEXT segments of an FCS file, returning the
+        dictionary of metadata without touching the DATA segment.
+
+        convert_metadata - convert the metadata into python appropreate types
+            (see read)
+    """
+    f = open(filename, 'r')
+    try:
+        (fcs_type, offsets) = _read_header(f)
+        metadata = _read_text(f, offsets[0], offsets[1])
+    finally:
+        f.close()
+
+    if convert_metadata:
+        _convert_metadata(metadata)
+    return metadata
+
+def read(filename, convert_metadata = True, mmap = False):
+    """
+        Reads in an FCS file, given by filename and returns a tuple containing
+        a numpy array and a dictionary of data.
+
+        convert_metadata - convert the metadata into python appropreate types
+            i.e., the string '15' becomes the integer 15
+
+        mmap - rather than reading the DATA segment into memory, return a
+            read-only np.memmap backed view of shape (n_parameters, n_events).
+            Each channel is then a strided view into the file and is only read
+            from disk when touched.  Files with per-channel integer widths are
+            always read into memory, and $PnR bit masks are not applied to
+            mapped integer data.
+
+        Integer data are masked to the number of bits given by $PnR; if the
+        channels differ in width the data are decoded into a float32 matrix.
+
+        Based on Laszlo Balkay's fca_readfcs.m from 3 Dec 2013.
+    """
+    f = open(filename, 'r')
+    try:
+        (fcs_type, offsets) = _read_header(f)
+        (header_start, header_stop, data_start, data_stop, analysis_start,
+                analysis_stop) = offsets
+        metadata = _read_text(f, header_start, header_stop)
+    except:
+        f.close()
+        raise
+
+    # NOTE Compensation matrices are left in the metadata; see spillover
+    # NOTE Rather than following Balkay's approach, we keep all key-value pairs 
+    #     from the TEXT section in a dictionary.
+    
+    ############################################################################
+    # Read in the DATA section
+    ############################################################################
+    data_start = _data_offset(data_start, metadata)
+    f.seek(data_start)
+    n_events = int(metadata['$TOT'])
+    n_parameters = int(metadata['$PAR'])
+    
+    if debug:
+        print "# events: %d; # parameters %d" % (n_events,n_parameters)
+        pp = pprint.PrettyPrinter(indent = 4)
+        pp.pprint(metadata)
+
+
+    data_type = _data_types(metadata)
+    if debug:
+        print data_type
+
+    if len(data_type) == 1 and mmap:
+        # Events are stored contiguously, so the transpose of the mapped
+        # (n_events, n_parameters) array gives channel-strided rows without a copy
+        data = np.memmap(filename, dtype = data_type[0], mode = 'r',
+                offset = data_start, shape = (n_events, n_parameters)).T
+    elif len(data_type) == 1:
         data = np.fromfile(f, dtype=data_type[0], count = n_parameters*n_events)
         data = data.reshape(n_parameters,n_events,order='F').copy()
+        _apply_masks(data, _range_masks(metadata, data_type))
     else:
-        # We need a separate data type for each parameter
-        data = []
-        for j in range(0,n_parameters):
-            data.append(np.fromfile(f,dtype=data_type[j], count=n_events))
+        # Channels have different widths: read every event as one record
+        # and decode all channels into a single float32 matrix
+        events = np.fromfile(f, dtype = _event_dtype(data_type, n_parameters), count = n_events)
+        data = _decode_events(events, data_type, _range_masks(metadata, data_type))
+    f.close()
    
     # TODO: Read analysis section of file
 
@@ -148,8 +379,7 @@ def read(filename, convert_metadata = True):
 
 
     if convert_metadata:
-        metadata['$TOT'] = int(metadata['$TOT'])
-        metadata['$PAR'] = int(metadata['$PAR'])
+        _convert_metadata(metadata)
 
 
 
@@ -159,9 +389,160 @@ def read(filename, convert_metadata = True):
 
 
 
-def save(filename, data, metadata, analysis = None, meta_analysis = None):
+def iter_events(filename, chunk_events = 65536):
+    """
+        Iterates over the DATA segment of an FCS file, yielding native-endian 
+        arrays of shape (n_parameters, n) with n <= chunk_events, so that files
+        larger than memory can be processed in bounded memory.
+
+        As with read, integer channels are masked according to $PnR and 
+        files whose integer channels have different widths yield float32 arrays.
+    """
+    f = open(filename, 'rb')
+    try:
+        (fcs_type, offsets) = _read_header(f)
+        metadata = _read_text(f, offsets[0], offsets[1])
+        n_events = int(metadata['$TOT'])
+        n_parameters = int(metadata['$PAR'])
+        data_type = _data_types(metadata)
+        event_dtype = _event_dtype(data_type, n_parameters)
+        masks = _range_masks(metadata, data_type)
+
+        f.seek(_data_offset(offsets[2], metadata))
+        for start in range(0, n_events, chunk_events):
+            count = min(chunk_events, n_events - start)
+            events = np.fromfile(f, dtype = event_dtype, count = count)
+            if len(events) < count:
+                raise Exception('Error: DATA segment ended after {} of {} events'.format(
+                        start + len(events), n_events))
+            yield _decode_events(events, data_type, masks)
+    finally:
+        f.close()
+
+# Keywords describing the layout of a file; these are recomputed by save
+_layout_keywords = ['$BEGINANALYSIS', '$ENDANALYSIS', '$BEGINDATA', '$ENDDATA',
+        '$BEGINSTEXT', '$ENDSTEXT', '$NEXTDATA', '$TOT', '$PAR', '$DATATYPE',
+        '$BYTEORD', '$MODE']
+
+def _format_text(keywords, delimiter = '/'):
+    """ Builds a TEXT segment from a list of (keyword, value) pairs."""
+    text = [delimiter]
+    for (key, value) in keywords:
+        if isinstance(value, (tuple, list)):
+            value = ','.join(str(v) for v in value)
+        value = str(value)
+        # Empty values are not allowed by the standard
+        if value == '':
+            value = ' '
+        # A delimiter inside a keyword or value is escaped by doubling it
+        text.append(key.replace(delimiter, 2*delimiter))
+        text.append(delimiter)
+        text.append(value.replace(delimiter, 2*delimiter))
+        text.append(delimiter)
+    return ''.join(text)
+
+def save(filename, data, metadata, analysis = None, meta_analysis = None,
+        index = None, datatype = 'f', chunk_events = 65536):
+    """
+        Writes an FCS 3.1 file containing list mode data.
+
+        data - array of shape (n_parameters, n_events), e.g., FlowData.data.
+            Memory-mapped arrays are read one chunk at a time.
+
+        metadata - dictionary of TEXT keywords, e.g., FlowData.metadata.  Keywords
+            describing the file layout ($TOT, $PAR, $DATATYPE, $PnB, $PnE, 
+            offsets, etc.) are replaced by ones describing the written file.
+
+        index - optional boolean mask or integer array selecting the events
+            (columns) of data to write, so a gated subset can be saved without
+            first copying it.
 
-    raise NotImplementedError
+        datatype - 'f' for float32 or 'd' for float64 data
+
+        chunk_events - number of events transposed and written at a time; this 
+            bounds the additional memory used.
+
+        The analysis segment is not written.
+    """
+    if datatype.lower() == 'f':
+        dtype = np.dtype('<f4')
+    elif datatype.lower() == 'd':
+        dtype = np.dtype('<f8')
+    else:
+        raise ValueError('datatype must be f or d; you gave {}'.format(datatype))
+
+    n_parameters = data.shape[0]
+    if index is None:
+        n_events = data.shape[1]
+    else:
+        index = np.asarray(index)
+        if index.dtype == bool:
+            index = np.flatnonzero(index)
+        n_events = len(index)
+
+    ############################################################################
+    # Build the TEXT section
+    ############################################################################
+    keywords = []
+    for key in sorted(metadata.keys()):
+        if key.upper() in _layout_keywords or re.match(r'\$P\d+[BE]$', key.upper()):
+            continue
+        keywords.append((key, metadata[key]))
+
+    keywords += [('$TOT', n_events), ('$PAR', n_parameters), 
+            ('$DATATYPE', datatype.upper()), ('$BYTEORD', '1,2,3,4'), ('$MODE', 'L'),
+            ('$NEXTDATA', 0), ('$BEGINANALYSIS', 0), ('$ENDANALYSIS', 0),
+            ('$BEGINSTEXT', 0), ('$ENDSTEXT', 0)]
+    for j in range(n_parameters):
+        keywords.append(('$P{}B'.format(j+1), 8*dtype.itemsize))
+        keywords.append(('$P{}E'.format(j+1), '0,0'))
+        if '$P{}N'.format(j+1) not in metadata:
+            keywords.append(('$P{}N'.format(j+1), 'P{}'.format(j+1)))
+        if '$P{}R'.format(j+1) not in metadata:
+            # The range is required; only compute it if we must
+            x = data[j] if index is None else data[j][index]
+            keywords.append(('$P{}R'.format(j+1), int(np.ceil(np.max(x))) if len(x) > 0 else 0))
+
+    # The length of the TEXT section depends on the digits of the data offsets
+    # it contains, so iterate until these are consistent
+    text_start = 58
+    data_bytes = n_events*n_parameters*dtype.itemsize
+    data_start = 0
+    while True:
+        data_stop = data_start + max(data_bytes, 1) - 1
+        text = _format_text(keywords + [('$BEGINDATA', data_start), ('$ENDDATA', data_stop)])
+        if text_start + len(text) == data_start:
+            break
+        data_start = text_start + len(text)
+    text_stop = data_start - 1
+
+    # Offsets too large for the HEADER are set to zero; readers find them in TEXT
+    if data_stop > 99999999:
+        header_data = (0, 0)
+    else:
+        header_data = (data_start, data_stop)
+    header = 'FCS3.1    {:8d}{:8d}{:8d}{:8d}{:8d}{:8d}'.format(text_start, text_stop,
+            header_data[0], header_data[1], 0, 0)
+
+    ############################################################################
+    # Write the file 
+    ############################################################################
+    f = open(filename, 'wb')
+    try:
+        f.write(header)
+        f.write(text)
+        # Transpose into event-major order one chunk at a time
+        buf = np.empty((min(chunk_events, n_events), n_parameters), dtype = dtype)
+        for start in range(0, n_events, chunk_events):
+            stop = min(start + chunk_events, n_events)
+            if index is None:
+                block = data[:, start:stop]
+            else:
+                block = data[:, index[start:stop]]
+            buf[:stop - start] = block.T
+            buf[:stop - start].tofile(f)
+    finally:
+        f.close()
 
 
 
@@ -3,14 +3,78 @@
 # A package containing a data structure for a single flow cytometry experiment
 
 import os
+import re
+from collections import namedtuple, OrderedDict
+from multiprocessing.pool import ThreadPool
 import numpy as np
 #import pandas as pd
 from functools32 import lru_cache
 import fcs
+import transform as transforms
+import sketch as sketches
 from kde import kde
 
 from tinytree import Tree
 
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+def _mangle(name):
+    """ Turns a channel name into a python identifier, e.g., 'CD45 (Yb)' 
+        becomes 'CD45_Yb'.
+    """
+    return re.sub(r'\W+', '_', name).strip('_')
+
+# Summary statistics of a channel; see FlowData.summary
+Summary = namedtuple('Summary', ['count', 'min', 'max', 'sum', 'sumsq', 'zeros'])
+
+def _summarize(data, chunk_events = 8192, events = None):
+    """ Summary of each row of the channel-major matrix data, computed in a
+        single pass over blocks of chunk_events events small enough to stay
+        in cache.  If given, only the columns events are summarized, 
+        gathering one block at a time.
+    """
+    nchannels = data.shape[0]
+    n = data.shape[1] if events is None else len(events)
+    low = np.full(nchannels, np.inf)
+    high = np.full(nchannels, -np.inf)
+    total = np.zeros(nchannels)
+    sumsq = np.zeros(nchannels)
+    zeros = np.zeros(nchannels, dtype = np.int64)
+    for start in range(0, n, chunk_events):
+        if events is None:
+            x = np.array(data[:, start:start + chunk_events], dtype = np.float64)
+        else:
+            x = np.array(data[:, events[start:start + chunk_events]], dtype = np.float64)
+        np.minimum(low, x.min(axis = 1), out = low)
+        np.maximum(high, x.max(axis = 1), out = high)
+        total += x.sum(axis = 1)
+        zeros += np.count_nonzero(x == 0, axis = 1)
+        x *= x
+        sumsq += x.sum(axis = 1)
+    return [Summary(n, low[j], high[j], total[j], sumsq[j], zeros[j]) for j in range(nchannels)]
+
+def _grid_points(kernel, bandwidth, xmin, xmax, npoints):
+    """ Number of grid points covered by the kernel, used to choose between
+        direct and binned density estimates.
+    """
+    if npoints < 2:
+        return 0
+    h = (xmax - xmin)/(npoints - 1)
+    support = 4. if kernel == 'gaussian' else 1.
+    return 2*support*bandwidth/h if h > 0 else 0
+
+def _is_cytof(metadata, tags):
+    """ Whether the file appears to come from a mass cytometer, either from
+        the $CYT keyword or from channels named after mass tags, e.g. Nd142Di.
+    """
+    if re.search(r'cytof|helios|fluidigm', str(metadata.get('$CYT', '')), re.I):
+        return True
+    mass = [t for t in tags if re.match(r'^[A-Z][a-z]?\d{2,3}D[id]$', t)]
+    return len(tags) > 0 and len(mass) > len(tags)/2
+
 class FlowData:
     """ A container class for flow cytometry data.
         
@@ -24,21 +88,71 @@ class FlowData:
             [ ] - returns slice of matrix based on rows
 
     """
-    _kernel_1D_list = ["hat"]
+    _kernel_1D_list = ["hat", "gaussian", "epanechnikov", "biweight", "triweight"]
+    _kernel_2D_list = ["hat", "gaussian"]
+    # An optional cache.FCSCache used when reading files
+    cache = None
+    # Channels, and transformed channels, a gated daughter keeps once 
+    # gathered from the root
+    _daughter_columns = 4
 
-    def __init__(self, path = None):
+    def __init__(self, path = None, mmap = False, dtype = None):
+        """ Load the FCS file path, if given.
 
+            mmap - memory map the events rather than reading them; channels
+                are then read from the file on first use.
+            dtype - precision in which channels are stored, e.g., np.float32
+                to halve the memory used by float64 files.  By default CyTOF
+                data is stored as np.float32 (mass cytometry counts carry far
+                less precision than that) and other data as read, but in 
+                native byte order.
+        """
+        # Gated daughters keep the root FlowData and the indices of their
+        # events in it rather than a copy of the data
+        self._root = None
+        self._events = None
+        # Channels materialized from a memory-mapped file or gathered from
+        # the root, keyed by row in order of use
+        self._columns = OrderedDict()
+        # Cached result of compensate
+        self._compensated = None
+        # Transformed channels, keyed by (row, transform, parameters) in 
+        # order of use
+        self._transformed = OrderedDict()
+        # Quantile sketches of channels, keyed by row
+        self._sketches = {}
+        # Summaries of channels, keyed by row
+        self._summaries = {}
         if not path is None:
-            (self._data, self._metadata, self._analysis, self._meta_analysis) = \
-                fcs.read(path, True)
+            if self.cache is not None:
+                (self._data, self._metadata, self._analysis, self._meta_analysis) = \
+                    self.cache.read(path, mmap = mmap)
+            else:
+                (self._data, self._metadata, self._analysis, self._meta_analysis) = \
+                    fcs.read(path, True, mmap = mmap)
             self._path = path
             self._filename = os.path.basename(path)
             self._original_length = self.nevents
+            self._set_channels(fcs.channels(self._metadata))
+            if dtype is None and _is_cytof(self._metadata, self._tags):
+                dtype = np.float32
+            self._dtype = np.dtype(self._data.dtype.newbyteorder('=') if dtype is None else dtype)
+            if not isinstance(self._data, np.memmap):
+                if self._data.dtype != self._dtype:
+                    self._data = self._data.astype(self._dtype)
+                # Memory-mapped channels are only summarized once read
+                self._summaries = dict(enumerate(_summarize(self._data)))
+            self._spillover = fcs.spillover(self._metadata)
         else:
             self._data = []
             self._metadata = {}
             self._analysis = []
             self._meta_analysis = {}
+            self._path = None
+            self._filename = ''
+            self._dtype = None if dtype is None else np.dtype(dtype)
+            self._set_channels([])
+            self._spillover = None
             # Number of variables in original dataset, in case we make a daughter,
             # for normalization when doing KDEs
             self._original_length = 0
@@ -47,7 +161,13 @@ class FlowData:
     def data(self):
         """ A numpy matrix where each row is an event (i.e., a cell) and each
             column is a channel (i.e., a detector)
+
+            For gated daughters this gathers every channel of the selected
+            events; prefer get or attribute access for single channels.
         """
+        if self._root is not None:
+            data = self._root._data[:, self._events]
+            return data.astype(self._dtype) if data.dtype != self._dtype else data
         return self._data
     @property
     def metadata(self):
@@ -74,22 +194,50 @@ class FlowData:
     @property
     def nevents(self):
         """ Number of events/cells"""
+        if self._events is not None:
+            return len(self._events)
+        if isinstance(self._data, np.ndarray):
+            return self._data.shape[1]
         return self._metadata['$TOT']
 
     @nevents.setter
     def nevents(self, n):
         self._metadata['$TOT'] = n
 
+    def _set_channels(self, channels):
+        """ Store the channel table (see fcs.channels) and the lists derived 
+            from it, which are computed once and shared with daughters.
+        """
+        self._channels = channels
+        self._tags = [c.name for c in channels]
+        self._markers = [c.marker for c in channels]
+
+        # Map each name to its row; exact tags take precedence over markers,
+        # and both over the mangled aliases usable as attributes
+        self._index = {}
+        for names in [self._tags, self._markers]:
+            for (j, name) in enumerate(names):
+                if name != '':
+                    self._index.setdefault(name, j)
+        for names in [self._tags, self._markers]:
+            for (j, name) in enumerate(names):
+                alias = _mangle(name)
+                if alias != '':
+                    self._index.setdefault(alias, j)
+
+    @property
+    def channels(self):
+        """ A list of fcs.Channel records (name, marker, bits, range, gain,
+            amplification), one for each channel.
+        """
+        return self._channels
+
     @property
     def tags(self):
         """ Names of the tag used (e.g., Xe131 for CyTOF; APC or Cy5 for
             flurorescent flow).  This corresponds to the $PnN channel in the
             corresponding FCS file.
         """
-        # Cache these values in the vector tags
-        self._tags = []
-        for j in range(self.nparameters):
-            self._tags.append(self._metadata['$P{}N'.format(j+1)])
         return self._tags
 
     @property
@@ -97,33 +245,232 @@ class FlowData:
         """ Name of the corresponding marker to each of the tags; e.g., CD45.
             This corresponds to the $PnS section of the FCS file.
         """
-        self._markers = []
-        for j in range(self.nparameters):
-            # add markers
-            self._markers.append(self._metadata.get('$P{}S'.format(j+1), ''))
         return self._markers
 
     @property
     def kernel_1D_list(self):
         return self._kernel_1D_list
 
+    @property
+    def kernel_2D_list(self):
+        return self._kernel_2D_list
+
+    def _daughter_cache(self, cache, key, make):
+        """ cache[key] of a daughter, computed by make() if absent; only the
+            _daughter_columns most recently used entries are kept.
+        """
+        if key in cache:
+            value = cache.pop(key)
+        else:
+            value = make()
+            if len(cache) >= self._daughter_columns:
+                cache.popitem(last = False)
+        cache[key] = value
+        return value
+
+    def _column(self, j):
+        """ Returns channel j as a contiguous, native-endian array.
+            Channels of memory-mapped data are read from disk on first use
+            and kept, so later accesses do not touch the file.  Daughters 
+            gather the channel from the root and keep only the 
+            _daughter_columns most recently used, so that a deep gate tree
+            costs memory in proportion to its events rather than to every
+            channel of every node.
+        """
+        if self._root is not None:
+            return self._daughter_cache(self._columns, j, lambda: self._root._column(j)[self._events])
+        if not isinstance(self._data, np.memmap):
+            return self._data[j]
+        if j not in self._columns:
+            dtype = self._dtype if self._dtype is not None else self._data.dtype.newbyteorder('=')
+            self._columns[j] = np.ascontiguousarray(self._data[j], dtype = dtype)
+        return self._columns[j]
+
+    def transform(self, channel, transform, *params):
+        """ Returns channel transformed by one of the functions in the 
+            transform module, named by transform (e.g., 'arcsinh', 'logicle',
+            'log') and applied with the given parameters, e.g.,
+                fd.transform('CD45', 'arcsinh', 5)
+            Results are kept, so repeated requests are free; gated daughters
+            keep only their most recent, as for channels (see _column).
+        """
+        row = self._channel_index(channel)
+        key = (row, transform, params)
+        if transform not in transforms.transforms:
+            raise ValueError('Unknown transform {}'.format(transform))
+        if self._root is not None:
+            # Share the transformed channel of the root
+            return self._daughter_cache(self._transformed, key, 
+                    lambda: self._root.transform(row, transform, *params)[self._events])
+        if key not in self._transformed:
+            self._transformed[key] = transforms.transforms[transform](self._column(row), *params)
+        return self._transformed[key]
+
+    def summary(self, channel):
+        """ A Summary (count, min, max, sum, sumsq, zeros) of channel, where
+            zeros is the number of events equal to zero.  These are computed
+            for every channel at load, or for memory-mapped files on first 
+            use.  Gated daughters summarize every channel in one pass over
+            the root when first asked, so a gate node is scanned once 
+            however often it is redrawn; a daughter holding all the events
+            of its parent shares its summaries.
+        """
+        row = self._channel_index(channel)
+        if row not in self._summaries:
+            root = self._root
+            if root is not None and not isinstance(root._data, np.memmap) and len(self._events) > 0:
+                self._summaries.update(enumerate(_summarize(root._data, events = self._events)))
+            else:
+                self._summaries[row] = _summarize(self._column(row)[np.newaxis, :])[0]
+        return self._summaries[row]
+
+    def sketch(self, channel):
+        """ A sketch.KLL quantile sketch of channel, built in one pass on 
+            first use and kept.  Sketches of different FlowData can be merged
+            with sketch.merge.
+        """
+        row = self._channel_index(channel)
+        if row not in self._sketches:
+            self._sketches[row] = sketches.KLL().update(self._column(row))
+        return self._sketches[row]
+
+    def quantile(self, channel, q):
+        """ Approximate q quantile(s) of channel, e.g., 
+                fd.quantile('CD45', [0.005, 0.5, 0.995])
+            for the median and a robust plotting range.  See sketch.
+        """
+        return self.sketch(channel).quantile(q)
+
     # TODO: Add memoize decorator to reduce computation time, perhaps also add threading option. 
     @lru_cache(maxsize=1000)
-    def kde1(self, channel, bandwidth = 0.5, kernel = 'hat', npoints = 1001):
+    def kde1(self, channel, bandwidth = 0.5, kernel = 'hat', npoints = 1001, transform = None,
+            method = 'auto'):
         """ Generate histogram
+
+            If given, the density is computed on a uniform grid in the
+            transformed coordinates; transform is either the name of a 
+            transform or a tuple of the name and its parameters, 
+            e.g., ('arcsinh', 5).  See FlowData.transform.
+
+            method - 'direct' sums the kernel over the grid points near each
+                event (kde.hat_linear), 'binned' bins the events onto the grid
+                and convolves (kde.binned), costing the same for any
+                bandwidth.  By default the binned estimate is used when the
+                kernel covers more than 8 grid points.
+            kernel - one of kernel_1D_list; for the gaussian kernel the 
+                bandwidth is the standard deviation.
         """
-        data = self.data[channel]
-        if len(data) == 0:
-            raise ValueError('Require nonempty data')
-        xmin = np.min(data)
-        xmax = np.max(data)
-        
-        if kernel == 'hat':
+        if kernel not in self._kernel_1D_list:
+            raise ValueError('Unknown kernel {}; choose from {}'.format(kernel, ', '.join(self._kernel_1D_list)))
+        (data, xmin, xmax) = self._kde_data(channel, transform)
+        if method == 'auto':
+            method = 'binned' if _grid_points(kernel, bandwidth, xmin, xmax, npoints) > 8 else 'direct'
+        if method == 'binned':
+            den = kde.binned(data, bandwidth, xmin, xmax, npoints, kernel)
+        elif method != 'direct':
+            raise ValueError('Unknown method {}'.format(method))
+        elif kernel == 'hat':
             den = kde.hat_linear(data, bandwidth, xmin, xmax, npoints)
+        else:
+            den = kde.kernel_linear(data, kernel, bandwidth, xmin, xmax, npoints)
         den = den*len(data)/self._original_length
         xgrid = np.linspace(xmin, xmax, npoints)
         return (xgrid, den)
 
+    @lru_cache(maxsize=1000)
+    def kde2(self, channel1, channel2, bandwidth = (0.5, 0.5), kernel = 'hat', npoints = (201, 201),
+            transform = None, method = 'auto'):
+        """ Two dimensional density of channel1 and channel2, e.g., for a 
+            biaxial plot, returning (xgrid, ygrid, den) with den[i, j] the
+            density at (xgrid[i], ygrid[j]).
+
+            The kernel is the product of the given kernel (one of 
+            kernel_2D_list) in each channel, with bandwidth and npoints given
+            for each channel.  transform applies to both channels, as in 
+            kde1.  method is as for kde1: 'direct' (kde.kernel2_linear) or
+            'binned' (kde.binned2), by default the latter when the kernel
+            covers more than 8 grid points along both axes.
+        """
+        if kernel not in self._kernel_2D_list:
+            raise ValueError('Unknown kernel {}; choose from {}'.format(kernel, ', '.join(self._kernel_2D_list)))
+        (x, xmin, xmax) = self._kde_data(channel1, transform)
+        (y, ymin, ymax) = self._kde_data(channel2, transform)
+        if method == 'auto':
+            points = [_grid_points(kernel, b, low, high, n) for (b, low, high, n) in 
+                      zip(bandwidth, (xmin, ymin), (xmax, ymax), npoints)]
+            method = 'binned' if min(points) > 8 else 'direct'
+        if method == 'binned':
+            den = kde.binned2(x, y, bandwidth, xmin, xmax, ymin, ymax, npoints, kernel)
+        elif method == 'direct':
+            den = kde.kernel2_linear(x, y, kernel, bandwidth, xmin, xmax, ymin, ymax, npoints)
+        else:
+            raise ValueError('Unknown method {}'.format(method))
+        den = den*len(x)/self._original_length
+        return (np.linspace(xmin, xmax, npoints[0]), np.linspace(ymin, ymax, npoints[1]), den)
+
+    def _kde_data(self, channel, transform):
+        """ The data of channel, transformed as described in kde1, and its
+            range.
+        """
+        if isinstance(transform, basestring):
+            transform = (transform,)
+        if transform is None:
+            data = self._column(self._channel_index(channel))
+        else:
+            data = self.transform(channel, *transform)
+        if len(data) == 0:
+            raise ValueError('Require nonempty data')
+        # The range comes from the summary; as every transform is
+        # increasing, it maps the extremes of the channel to those of the
+        # transformed data
+        summary = self.summary(channel)
+        (xmin, xmax) = (summary.min, summary.max)
+        if transform is not None:
+            (xmin, xmax) = transforms.transforms[transform[0]](np.array([xmin, xmax]), *transform[1:])
+        return (data, xmin, xmax)
+
+    def kde1_batch(self, channels, masks = None, bandwidth = 0.5, npoints = 1001, transform = None):
+        """ Hat kernel densities of several channels for several populations
+            of the events of this FlowData, e.g., the masks of gate tree 
+            nodes from FlowAnalysis.gate_masks, computed by 
+            kde.hat_linear_batch in a single pass over the events.
+
+            Returns (xgrids, den), where xgrids[i] is the grid of channels[i]
+            and den[i, j] its density in the population masks[j], scaled as
+            in kde1.  Other parameters are as for kde1, with bandwidth either
+            a single value or one per channel.
+        """
+        rows = [self._channel_index(c) for c in channels]
+        if self.nevents == 0:
+            raise ValueError('Require nonempty data')
+        if masks is None:
+            masks = np.ones((1, self.nevents), dtype = bool)
+        masks = np.atleast_2d(np.asarray(masks, dtype = bool))
+        counts = masks.sum(axis = 1)
+        if isinstance(transform, basestring):
+            transform = (transform,)
+
+        xmin = np.array([self.summary(r).min for r in rows])
+        xmax = np.array([self.summary(r).max for r in rows])
+        if transform is None:
+            # Read the channels in place from the root, with the masks
+            # taken to its events
+            root = self if self._root is None else self._root
+            matrix = root._data
+            if self._root is not None:
+                expanded = np.zeros((len(masks), root.nevents), dtype = bool)
+                expanded[:, self._events] = masks
+                masks = expanded
+        else:
+            (xmin, xmax) = transforms.transforms[transform[0]](np.array([xmin, xmax]), *transform[1:])
+            matrix = np.vstack([self.transform(r, *transform) for r in rows])
+            rows = range(len(rows))
+
+        den = kde.hat_linear_batch(matrix, rows, masks, bandwidth, xmin, xmax, npoints)
+        den *= counts[np.newaxis, :, np.newaxis]/float(self._original_length)
+        xgrids = [np.linspace(lo, hi, npoints) for (lo, hi) in zip(xmin, xmax)]
+        return (xgrids, den)
+
     def __getattr__(self, name):
         """ Provides access to the data channels/markers in their original names
             (inspired by pandas)
@@ -135,28 +482,67 @@ class FlowData:
             If we provide a boolian vector of length nevents, we generate a new 
             FlowData object, with the selected rows
         """
-        # TODO: most tags/markers are not valid property names, use regular expressions
-        # to allow these to be called in a normalized fashion
-        # i.e., this should do some name mangling
-        if name in self.tags:
-            return self._data[self.tags.index(name)]
-        if name in self.markers:
-            return self._data[self.markers.index(name)]
-    
-        raise AttributeError("Attribute {} not defined".format(name))
+        # Most tags/markers are not valid property names, so we also accept
+        # names mangled into identifiers, e.g., fd.CD45_Yb for 'CD45 (Yb)'
+        if name.startswith('_'):
+            raise AttributeError("Attribute {} not defined".format(name))
+        return self._column(self._channel_index(name))
+
+    def _channel_index(self, name):
+        """ Row of the channel with the given tag, marker, or mangled alias of
+            either; integers are taken to be rows already.
+        """
+        if isinstance(name, (int, long, np.integer)):
+            return name
+        try:
+            return self._index[name]
+        except KeyError:
+            raise AttributeError("Attribute {} not defined".format(name))
+
+    def _daughter(self, data = None, events = None, analysis = None):
+        """ A FlowData sharing the metadata and channels of this one holding
+            either the given data or the given events of the root FlowData.
+        """
+        fd = FlowData()
+        if events is None:
+            fd._data = data
+        else:
+            fd._root = self if self._root is None else self._root
+            fd._data = fd._root._data
+            fd._events = events
+        if analysis is not None:
+            fd._analysis = analysis
+        fd._metadata = self._metadata
+        (fd._channels, fd._tags, fd._markers) = (self._channels, self._tags, self._markers)
+        fd._index = self._index
+        # Daughters of the root read its spillover, so later changes apply
+        fd._spillover = self._spillover if events is None else None
+        fd._dtype = self._dtype
+        fd._original_length = self._original_length
+        fd._meta_analysis = self._meta_analysis
+        return fd
 
     def __getitem__(self, index): 
         # In this case, we return a FlowData object with the selected rows
         if index.__class__ is np.ndarray:
             if len(index) == self.nevents:
-                fd = FlowData()
-                fd._data = self._data[:,index]
+                analysis = None
                 if self._analysis.__class__ is np.ndarray:
-                    fd._analysis = self._analysis[:,index]
-                fd._metadata = self._metadata
-                fd.nevents = fd._data.shape[1]
-                fd._original_length = self._original_length
-                fd._meta_analysis = self._meta_analysis
+                    analysis = self._analysis[:,index]
+                # Rather than copying the selected events, keep their indices
+                # in the root; channels are only gathered when requested
+                if index.dtype == bool:
+                    events = np.flatnonzero(index)
+                else:
+                    events = index
+                if self._events is not None:
+                    events = self._events[events]
+                elif self.nevents < 2**31:
+                    events = events.astype(np.int32)
+                fd = self._daughter(events = events, analysis = analysis)
+                if len(events) == self.nevents and index.dtype == bool:
+                    # The same events, so the same summaries
+                    fd._summaries = self._summaries
                 return fd
             else:
                 raise AttributeError("Dimension Mismatch")
@@ -168,13 +554,67 @@ class FlowData:
         """ Similar to __getattr__, but this formulation can parse pure strings,
             rather than
         """
-        if name in self.tags:
-            return self._data[self.tags.index(name)]
-        if name in self.markers:
-            return self._data[self.markers.index(name)]
-        raise AttributeError("Attribute {} not defined".format(name))
+        return self._column(self._channel_index(name))
+
+    @property
+    def spillover(self):
+        """ The spillover matrix used by compensate as a tuple (channels, matrix),
+            where matrix[i,j] is the fraction of the signal of channels[i]
+            detected in channels[j], or None.  This is read from the FCS file
+            (see fcs.spillover) and can be changed with set_spillover.  Gated
+            daughters share the spillover matrix of the root.
+        """
+        return self._spillover if self._root is None else self._root._spillover
+
+    def set_spillover(self, channels, matrix):
+        """ Replace the spillover matrix; channels are tags, markers or rows."""
+        matrix = np.array(matrix, dtype = np.float64)
+        if matrix.shape != (len(channels), len(channels)):
+            raise ValueError('Spillover matrix must be {0} by {0}'.format(len(channels)))
+        fd = self if self._root is None else self._root
+        fd._spillover = (list(channels), matrix)
+        fd._compensated = None
+
+    def compensate(self, chunk_events = 65536):
+        """ Returns a FlowData with the spillover removed from the data.
+
+            An observed event is the true event times the spillover matrix S,
+            so for our channel-major data D_obs = S^T D.  S^T is inverted once
+            and applied to each chunk of chunk_events events as it is copied
+            into the result, so memory-mapped files are never read whole.  
+            Gated daughters take their events from the compensated root.  The
+            result is cached until the spillover matrix is changed.
+        """
+        spillover = self.spillover
+        if spillover is None:
+            raise ValueError('No spillover matrix defined')
+        if self._compensated is not None and self._compensated[0] is spillover:
+            return self._compensated[1]
+        if self._root is not None:
+            fd = self._root.compensate(chunk_events)._daughter(events = self._events, 
+                    analysis = self._analysis)
+        else:
+            (channels, matrix) = spillover
+            rows = [self._channel_index(c) for c in channels]
+            inverse = np.linalg.inv(matrix.T)
+            dtype = np.float64 if self._dtype == np.float64 else np.float32
+            data = np.empty((len(self._channels), self.nevents), dtype = dtype)
+            for start in range(0, data.shape[1], chunk_events):
+                stop = min(start + chunk_events, data.shape[1])
+                data[:, start:stop] = self._data[:, start:stop]
+                data[rows, start:stop] = np.dot(inverse, data[rows, start:stop])
+            fd = self._daughter(data)
+            fd._dtype = data.dtype
+        self._compensated = (spillover, fd)
+        return fd
         
 
+    def save(self, path, datatype = 'f'):
+        """ Write the events of this FlowData, e.g., a gated daughter, to the 
+            FCS file path.  See fcs.save.
+        """
+        fcs.save(path, self._data, self._metadata, index = self._events, datatype = datatype)
+
     def normalize(self):
         """ Names comming from our lab are not always right, 
             fix these
@@ -209,6 +649,26 @@ class FlowAnalysis:
         self._fd.append(FlowData(filename))
         t = self._make_gate(len(self._fd)-1)
         t.title = self._fd[-1].filename
+
+    def load_many(self, filenames, workers = None):
+        """ Load several fcs files into the analysis set.
+
+            Files are parsed concurrently on a pool of workers threads (numpy
+            file I/O releases the GIL); the default is one per CPU.
+            They are appended in the order given, and the gate tree is only
+            extended once all files have been read.
+        """
+        pool = ThreadPool(workers)
+        try:
+            fds = pool.map(FlowData, filenames)
+        finally:
+            pool.close()
+            pool.join()
+
+        for fd in fds:
+            self._fd.append(fd)
+            t = self._make_gate(len(self._fd)-1)
+            t.title = fd.filename
     
     def append(self, item):
         self._fd.append(item)
@@ -264,6 +724,106 @@ class FlowAnalysis:
     def flow_data(self):
         return self._fd
 
+    def gate_masks(self, gate_tree = None, workers = None):
+        """ Evaluate every node of gate_tree (by default, self.gate_tree) on
+            every file that reaches it, returning a dictionary mapping 
+            (node, file index) to the boolean mask of the events of that file
+            selected by the node.
+
+            Each file is one job, dispatched to a pool of workers threads
+            (numpy and numexpr release the GIL); the default is one per CPU.
+            Within a file, each node only evaluates its own gates, fused into
+            one, and combines the result with the mask of its parent.  Nodes
+            without event gates share the mask of their parent.
+        """
+        if gate_tree is None:
+            gate_tree = self.gate_tree
+        pool = ThreadPool(workers)
+        try:
+            results = pool.map(lambda i: _tree_masks(gate_tree, self._fd[i], i), range(len(self._fd)))
+        finally:
+            pool.close()
+            pool.join()
+
+        masks = {}
+        for (i, file_masks) in enumerate(results):
+            for (node, mask) in file_masks:
+                masks[(node, i)] = mask
+        return masks
+
+def _tree_masks(gate_tree, flow_data, index):
+    """ List of (node, mask) for the nodes of gate_tree reached by flow_data,
+        the file index in the analysis.
+    """
+    masks = []
+    def walk(node, parent_mask):
+        gates = []
+        for gate in node.gates:
+            if isinstance(gate, GateIndex):
+                if gate.index != index:
+                    return
+            else:
+                gates.append(gate)
+        if len(gates) == 0:
+            mask = parent_mask
+        else:
+            mask = GateAnd(*gates).mask(flow_data)
+            mask &= parent_mask
+        masks.append((node, mask))
+        for child in node.children:
+            walk(child, mask)
+    walk(gate_tree, np.ones(flow_data.nevents, dtype = bool))
+    return masks
+
+
+def _fuse(gates):
+    """ Combine each run of consecutive event gates into one GateAnd, so it
+        is applied with a single mask.
+    """
+    fused = []
+    run = []
+    for gate in gates:
+        if isinstance(gate, GateIndex):
+            if len(run) > 0:
+                fused.append(run[0] if len(run) == 1 else GateAnd(*run))
+                run = []
+            fused.append(gate)
+        else:
+            run.append(gate)
+    if len(run) > 0:
+        fused.append(run[0] if len(run) == 1 else GateAnd(*run))
+    return fused
+
+# Statistics computed by GateTree.statistics and the type of their field
+_statistics = {'count': np.int64, 'frequency': np.float64, 'total_frequency': np.float64,
+               'median': np.float64, 'mean': np.float64}
+
+def _percent(count, total):
+    return 100.*count/total if total > 0 else np.nan
+
+def _median(x):
+    """ Median of x found by partitioning in place."""
+    n = len(x)
+    if n == 0:
+        return np.nan
+    k = n//2
+    x.partition(k)
+    if n % 2 == 1:
+        return float(x[k])
+    # The largest of the lower half is the maximum of the first k values
+    return (float(x[k]) + float(np.max(x[:k])))/2
+
+def _mean(x):
+    return float(np.mean(x, dtype = np.float64)) if len(x) > 0 else np.nan
+
+def _sketch_median(x, mask, chunk_events = 65536):
+    """ Median of x[mask] estimated with a sketch.KLL, built a chunk of 
+        events at a time so the population is never gathered.
+    """
+    s = sketches.KLL()
+    for start in range(0, len(x), chunk_events):
+        s.update(x[start:start + chunk_events][mask[start:start + chunk_events]])
+    return s.quantile(0.5)
 
 class GateTree(Tree):
     """
@@ -281,20 +841,154 @@ class GateTree(Tree):
     """
 
     def __init__(self, children = None):
+        # Result of the last call to gate; see gate
+        self._cached = None
         super(GateTree, self).__init__(children)
         self.gates = []
         self.title = ''
 
+    @property
+    def gates(self):
+        return self._gates
+
+    @gates.setter
+    def gates(self, gates):
+        self._gates = gates
+        self.invalidate()
+
+    def invalidate(self):
+        """ Discard the cached results of this node and its descendants."""
+        for t in self.preOrder():
+            t._cached = None
+
     def gate(self, flow_data):
         """ Apply gates to the provided data sets.
 
+            Each node keeps its last result, keyed by the identity of 
+            flow_data, the result of its parent and the parameters of its
+            gates, so after a gate changes only that node and its descendants
+            are recomputed.
         """
         # We need to start from the top and work downwards towards the current gate
+        if self.parent is None:
+            parent_data = flow_data
+        else:
+            parent_data = self.parent.gate(flow_data)
+
+        # Keep references to the inputs so their ids cannot be reused
+        if flow_data.__class__ == [].__class__:
+            inputs = list(flow_data)
+            key = [id(fd) for fd in inputs]
+        else:
+            inputs = flow_data
+            key = id(flow_data)
+        key = (key, [gate.key() for gate in self.gates])
+
+        if self._cached is not None:
+            (cached_inputs, cached_parent, cached_key, result) = self._cached
+            if cached_parent is parent_data and cached_key == key:
+                return result
 
-        for gt in self.pathFromRoot():
-            for gate in gt.gates:
-                flow_data = gate.apply(flow_data)
-        return flow_data
+        result = parent_data
+        for gate in _fuse(self.gates):
+            result = gate.apply(result)
+        self._cached = (inputs, parent_data, key, result)
+        return result
+
+    def compile(self):
+        """ Combines the event gates on the path from the root to this node
+            into a single gate, so the whole path can be evaluated in one 
+            pass producing one mask.  Index gates, which select files, are
+            left out; see mask.
+        """
+        gates = [g for t in self.pathFromRoot() for g in t.gates 
+                 if not isinstance(g, GateIndex)]
+        return GateAnd(*gates)
+
+    def mask(self, flow_data):
+        """ Boolean mask of the events of flow_data, a single FlowData, 
+            selected by every event gate on the path to this node.
+        """
+        gate = self.compile()
+        if len(gate.gates) == 0:
+            return np.ones(flow_data.nevents, dtype = bool)
+        return gate.mask(flow_data)
+
+    def statistics(self, flow_analysis, channels = (), stats = ('count', 'frequency', 'median'), 
+            approximate = None, frame = False, workers = None):
+        """ Statistics of the events selected by this node and each of its
+            descendants in every file of flow_analysis reaching them, as a
+            numpy structured array with one row per (node, file) holding the
+            fields node (the GateTree), title, file (the index in 
+            flow_analysis), filename and the requested stats:
+
+                count - number of events
+                frequency - percent of the events of the parent node
+                total_frequency - percent of all events in the file
+                median, mean - of each channel, stored in fields named 
+                    e.g., 'median CD3'
+
+            The whole tree is gated once with FlowAnalysis.gate_masks, and 
+            each population is then selected once for all channels; medians
+            are found by partitioning rather than sorting.
+
+            approximate - if given, medians of populations of more than 
+                this many events are estimated with quantile sketches (see
+                sketch.KLL): those of whole files from FlowData.quantile, 
+                and those of gated populations from a sketch built in one 
+                pass over the mask.  Means are always exact.
+            frame - return a pandas DataFrame instead
+        """
+        for stat in stats:
+            if stat not in _statistics:
+                raise ValueError('Unknown statistic {}; choose from {}'.format(stat, ', '.join(_statistics)))
+        channels = list(channels)
+        masks = flow_analysis.gate_masks(self.getRoot(), workers = workers)
+
+        fields = [('node', object), ('title', object), ('file', np.int64), ('filename', object)]
+        for stat in stats:
+            if stat in ('median', 'mean'):
+                fields += [('{} {}'.format(stat, c), np.float64) for c in channels]
+            else:
+                fields.append((stat, _statistics[stat]))
+
+        rows = []
+        for node in self.preOrder():
+            for (i, fd) in enumerate(flow_analysis.flow_data):
+                if (node, i) not in masks:
+                    continue
+                mask = masks[(node, i)]
+                row = [node, node.title, i, fd.filename]
+                events = None
+                count = np.count_nonzero(mask)
+                large = approximate is not None and count > approximate
+                for stat in stats:
+                    if stat == 'count':
+                        row.append(count)
+                    elif stat == 'frequency':
+                        parent = masks[(node.parent, i)] if node.parent is not None else mask
+                        row.append(_percent(count, np.count_nonzero(parent)))
+                    elif stat == 'total_frequency':
+                        row.append(_percent(count, len(mask)))
+                    else:
+                        for c in channels:
+                            if stat == 'median' and large:
+                                if count == len(mask):
+                                    row.append(fd.quantile(c, 0.5))
+                                else:
+                                    row.append(_sketch_median(fd.get(c), mask))
+                                continue
+                            if events is None:
+                                events = np.flatnonzero(mask)
+                            x = fd.get(c).take(events)
+                            row.append(_median(x) if stat == 'median' else _mean(x))
+                rows.append(tuple(row))
+
+        table = np.array(rows, dtype = fields)
+        if frame:
+            import pandas as pd
+            return pd.DataFrame.from_records(table)
+        return table
 
     def __str__(self):
         root = self.getRoot()
@@ -313,10 +1007,105 @@ class GateTree(Tree):
             return walk(self, 0)
 
 
+# Elementwise comparisons used by gates, and their numexpr spelling
+_inequalities = {'=': np.equal, '<': np.less, '>': np.greater, 
+                 '<=': np.less_equal, '>=': np.greater_equal}
+_numexpr_inequalities = {'=': '==', '<': '<', '>': '>', '<=': '<=', '>=': '>='}
+
+def _constant(constants, value):
+    """ Name of a numexpr variable for value, added to the dictionary 
+        constants; bounds are passed this way since values such as inf and
+        nan cannot be written into an expression.
+    """
+    name = 'k{}'.format(len(constants))
+    constants[name] = float(value)
+    return name
+
+def _check_inequality(inequality):
+    if not inequality in _inequalities:
+        raise ValueError('inequality provided must be one of <, >, <=, >=, =; you gave {}'.format(inequality))
+
 class GateVirtual:
-    def apply(self):
+    """ Base class for gates.
+
+        Gates selecting events are built from a boolean mask over the events
+        of a FlowData.  They may be combined with &, | and ~ (or GateAnd, 
+        GateOr and GateNot) into a single gate whose mask is computed in one
+        pass: with numexpr if it is installed, and otherwise in chunks of 
+        events written into one preallocated output, so that no intermediate
+        FlowData or full length temporaries are created.
+
+        Subclasses implement channels, evaluate and expression.
+    """
+    def apply(self, flow_data):
+        if flow_data.__class__ == [].__class__:
+            # If we have a list of flow data, call on each element of list
+            # append to the returned list
+            flow_data_new = []
+            for fd in flow_data:
+                flow_data_new.append(self.apply(fd))
+            return flow_data_new
+        else:
+            return flow_data[self.mask(flow_data)]
+
+    def key(self):
+        """ A hashable summary of the parameters of the gate, used by GateTree
+            to determine if cached results are still valid.
+        """
+        raise NotImplementedError
+
+    def channels(self):
+        """ List of the channels the gate reads."""
+        raise NotImplementedError
+
+    def evaluate(self, get, out):
+        """ Write the mask for a block of events into the boolean array out,
+            where get(channel) returns that channel for the same block.
+        """
         raise NotImplementedError
 
+    def expression(self, names, constants):
+        """ numexpr expression for the mask, given a dictionary of the
+            variable names used for each channel, or None if the gate
+            cannot be written as one.  Numeric parameters are added to the
+            dictionary constants with _constant and referred to by name.
+        """
+        raise NotImplementedError
+
+    def mask(self, flow_data, chunk_events = 65536):
+        """ Boolean mask of the events of flow_data selected by the gate."""
+        channels = []
+        for c in self.channels():
+            if c not in channels:
+                channels.append(c)
+        names = dict((c, 'c{}'.format(j)) for (j, c) in enumerate(channels))
+        columns = dict((names[c], flow_data.get(c)) for c in channels)
+
+        # uint64 columns are left to numpy, as numexpr cannot read them
+        if numexpr is not None and all(transforms._numexpr_supports(x) for x in columns.values()):
+            constants = {}
+            expression = self.expression(names, constants)
+            if expression is not None:
+                columns.update(constants)
+                return numexpr.evaluate(expression, local_dict = columns)
+
+        n = flow_data.nevents
+        out = np.empty(n, dtype = bool)
+        for start in range(0, n, chunk_events):
+            stop = min(start + chunk_events, n)
+            get = lambda c: columns[names[c]][start:stop]
+            self.evaluate(get, out[start:stop])
+        return out
+
+    def __and__(self, other):
+        return GateAnd(self, other)
+
+    def __or__(self, other):
+        return GateOr(self, other)
+
+    def __invert__(self):
+        return GateNot(self)
+
     def __str__(self):
         return ' '
 
@@ -331,39 +1120,376 @@ class GateIndex(GateVirtual):
     def apply(self, flow_data):
         return flow_data[self.index] 
 
+    def key(self):
+        return ('index', self.index)
+
     def __str__(self):
         return 'Index = {}'.format(self.index)
 
 
 class GateBound(GateVirtual):
+    """ Events where channel (in)equality bound holds, e.g., CD45 > 10."""
     def __init__(self, channel, inequality, bound):
         self.channel = channel
-        if not inequality in ['=', '<=', '>=', '<', '>']:
-            raise ValueError('inequality provided must be one of <, >, <=, >=, =; you gave {}'.format(inequality))
+        _check_inequality(inequality)
         self.inequality = inequality
         self.bound = bound
 
-    def apply(self, flow_data):
-        if flow_data.__class__ == [].__class__:
-            # If we have a list of flow data, call on each element of list
-            # append to the returned list
-            flow_data_new = []
-            for fd in flow_data:
-                flow_data_new.append(self.apply(fd))
-            return flow_data_new
-        else:
-            selected_data = flow_data.get(self.channel)
-            index = {
-                '=':  lambda x: x == self.bound,
-                '<':  lambda x: x < self.bound,
-                '>':  lambda x: x > self.bound,
-                '<=': lambda x: x <= self.bound,
-                '>=': lambda x: x >= self.bound
-            }[self.inequality](selected_data)
+    def key(self):
+        return ('bound', self.channel, self.inequality, self.bound)
+
+    def channels(self):
+        return [self.channel]
+
+    def evaluate(self, get, out):
+        _inequalities[self.inequality](get(self.channel), self.bound, out = out)
 
-            return flow_data[index]
+    def expression(self, names, constants):
+        return '({} {} {})'.format(names[self.channel], 
+                _numexpr_inequalities[self.inequality], _constant(constants, self.bound))
 
     def __str__(self):
         return self.channel + ' ' + self.inequality + ' ' + '{}'.format(self.bound)
 
-            
+
+class GateRange(GateVirtual):
+    """ Events with low <= channel <= high."""
+    def __init__(self, channel, low, high):
+        self.channel = channel
+        self.low = low
+        self.high = high
+
+    def key(self):
+        return ('range', self.channel, self.low, self.high)
+
+    def channels(self):
+        return [self.channel]
+
+    def evaluate(self, get, out):
+        x = get(self.channel)
+        np.greater_equal(x, self.low, out = out)
+        out &= (x <= self.high)
+
+    def expression(self, names, constants):
+        return '(({1} <= {0}) & ({0} <= {2}))'.format(names[self.channel],
+                _constant(constants, self.low), _constant(constants, self.high))
+
+    def __str__(self):
+        return '{} <= {} <= {}'.format(self.low, self.channel, self.high)
+
+
+class GateCompare(GateVirtual):
+    """ Events where channel1 (in)equality channel2 holds, e.g., CD4 > CD8."""
+    def __init__(self, channel1, inequality, channel2):
+        self.channel1 = channel1
+        _check_inequality(inequality)
+        self.inequality = inequality
+        self.channel2 = channel2
+
+    def key(self):
+        return ('compare', self.channel1, self.inequality, self.channel2)
+
+    def channels(self):
+        return [self.channel1, self.channel2]
+
+    def evaluate(self, get, out):
+        _inequalities[self.inequality](get(self.channel1), get(self.channel2), out = out)
+
+    def expression(self, names, constants):
+        return '({} {} {})'.format(names[self.channel1], 
+                _numexpr_inequalities[self.inequality], names[self.channel2])
+
+    def __str__(self):
+        return self.channel1 + ' ' + self.inequality + ' ' + self.channel2
+
+
+class GateRectangle(GateVirtual):
+    """ Events with x_range[0] <= channel1 <= x_range[1] and 
+        y_range[0] <= channel2 <= y_range[1].
+    """
+    def __init__(self, channel1, channel2, x_range, y_range):
+        self.channel1 = channel1
+        self.channel2 = channel2
+        self.x_range = tuple(x_range)
+        self.y_range = tuple(y_range)
+
+    def key(self):
+        return ('rectangle', self.channel1, self.channel2, tuple(self.x_range), tuple(self.y_range))
+
+    def channels(self):
+        return [self.channel1, self.channel2]
+
+    def evaluate(self, get, out):
+        x = get(self.channel1)
+        y = get(self.channel2)
+        np.greater_equal(x, self.x_range[0], out = out)
+        out &= (x <= self.x_range[1])
+        out &= (y >= self.y_range[0])
+        out &= (y <= self.y_range[1])
+
+    def expression(self, names, constants):
+        bounds = [_constant(constants, b) for b in self.x_range + self.y_range]
+        return '(({1} <= {0}) & ({0} <= {2}) & ({4} <= {3}) & ({3} <= {5}))'.format(
+                names[self.channel1], bounds[0], bounds[1], names[self.channel2], bounds[2], bounds[3])
+
+    def __str__(self):
+        return '{} <= {} <= {}, {} <= {} <= {}'.format(self.x_range[0], self.channel1, self.x_range[1],
+                self.y_range[0], self.channel2, self.y_range[1])
+
+
+class GateEllipse(GateVirtual):
+    """ Events inside the ellipse in the (channel1, channel2) plane with the
+        given center and semi-axes, rotated counterclockwise by angle
+        (in radians).
+    """
+    def __init__(self, channel1, channel2, center, axes, angle = 0.):
+        self.channel1 = channel1
+        self.channel2 = channel2
+        self.center = tuple(center)
+        self.axes = tuple(axes)
+        if not (self.axes[0] > 0 and self.axes[1] > 0):
+            raise ValueError('Semi-axes of an ellipse must be positive; you gave {}'.format(self.axes))
+        self.angle = angle
+
+    def key(self):
+        return ('ellipse', self.channel1, self.channel2, tuple(self.center), tuple(self.axes), self.angle)
+
+    def channels(self):
+        return [self.channel1, self.channel2]
+
+    def _coefficients(self):
+        # Rotated coordinates divided by the semi-axes, 
+        #   u = a11 (x - cx) + a12 (y - cy),  v = a21 (x - cx) + a22 (y - cy)
+        (c, s) = (np.cos(self.angle), np.sin(self.angle))
+        (a, b) = (float(self.axes[0]), float(self.axes[1]))
+        return (c/a, s/a, -s/b, c/b)
+
+    def evaluate(self, get, out):
+        x = get(self.channel1) - self.center[0]
+        y = get(self.channel2) - self.center[1]
+        (a11, a12, a21, a22) = self._coefficients()
+        u = a11*x + a12*y
+        v = a21*x
+        v += a22*y
+        u *= u
+        v *= v
+        u += v
+        np.less_equal(u, 1., out = out)
+
+    def expression(self, names, constants):
+        (a11, a12, a21, a22) = [_constant(constants, a) for a in self._coefficients()]
+        x = '({} - {})'.format(names[self.channel1], _constant(constants, self.center[0]))
+        y = '({} - {})'.format(names[self.channel2], _constant(constants, self.center[1]))
+        return '(({1}*{0} + {2}*{5})**2 + ({3}*{0} + {4}*{5})**2 <= 1.)'.format(
+                x, a11, a12, a21, a22, y)
+
+    def __str__(self):
+        return 'Ellipse({}, {}) center {} axes {} angle {}'.format(self.channel1, self.channel2,
+                self.center, self.axes, self.angle)
+
+
+class GatePolygon(GateVirtual):
+    """ Events inside the polygon in the (channel1, channel2) plane with the
+        given list of (x, y) vertices, e.g., a region drawn on a plot.
+
+        Points are tested by counting crossings of a ray to their right with
+        the edges of the polygon (even-odd rule), vectorized over events.
+        Only events inside the bounding box are considered, and these are
+        first looked up in a grid over the box whose cells are marked as
+        inside, outside or touched by an edge; only events in the last kind
+        of cell are tested, and then only against the edges in their
+        horizontal slab rather than every edge.
+    """
+    def __init__(self, channel1, channel2, vertices):
+        self.channel1 = channel1
+        self.channel2 = channel2
+        self.vertices = [tuple(v) for v in vertices]
+        if len(self.vertices) < 3:
+            raise ValueError('A polygon requires at least three vertices')
+        self._edges = None
+
+    def key(self):
+        return ('polygon', self.channel1, self.channel2, tuple(tuple(v) for v in self.vertices))
+
+    def channels(self):
+        return [self.channel1, self.channel2]
+
+    def _edge_index(self):
+        """ The bounding box, the grid of cell states and the edges crossing
+            each slab, stored as padded (nslabs, width) tables of the start
+            point and inverse slope of each edge.
+        """
+        key = self.key()
+        if self._edges is not None and self._edges[0] == key:
+            return self._edges[1]
+
+        xy = np.array(self.vertices, dtype = np.float64)
+        (xa, ya) = (xy[:,0], xy[:,1])
+        (xb, yb) = (np.roll(xa, -1), np.roll(ya, -1))
+        dy = yb - ya
+        flat = (dy == 0)
+        slope = (xb - xa)/np.where(flat, 1., dy)
+        slope[flat] = 0.
+        box = (xa.min(), xa.max(), ya.min(), ya.max())
+
+        # Slabs of edges
+        nslabs = len(xa)
+        height = _cell_size(box[2], box[3], nslabs)
+        first = _cell(np.minimum(ya, yb), box[2], height, nslabs)
+        last = _cell(np.maximum(ya, yb), box[2], height, nslabs)
+        buckets = [[] for k in range(nslabs)]
+        for (e, (i, j)) in enumerate(zip(first, last)):
+            if not flat[e]:
+                for k in range(i, j + 1):
+                    buckets[k].append(e)
+        width = max(1, max(len(b) for b in buckets))
+        # Padding edges have ya = yb, so never count as a crossing
+        table = np.zeros((4, nslabs, width))
+        for (k, b) in enumerate(buckets):
+            table[0, k, :len(b)] = xa[b]
+            table[1, k, :len(b)] = ya[b]
+            table[2, k, :len(b)] = yb[b]
+            table[3, k, :len(b)] = slope[b]
+        slabs = (height, nslabs, width, table.reshape(4, -1))
+
+        # Grid of cells; those touched by the bounding box of an edge are
+        # marked 2, the rest take the state of their center
+        ngrid = min(256, 8*len(xa))
+        size = (_cell_size(box[0], box[1], ngrid), _cell_size(box[2], box[3], ngrid))
+        centers = (np.arange(ngrid) + 0.5)
+        (cx, cy) = np.meshgrid(box[0] + centers*size[0], box[2] + centers*size[1])
+        cells = _crossings(cx.ravel(), cy.ravel(), box[2], slabs).astype(np.int8)
+        cells = cells.reshape(ngrid, ngrid)
+        (ix0, ix1) = (_cell(np.minimum(xa, xb), box[0], size[0], ngrid), 
+                      _cell(np.maximum(xa, xb), box[0], size[0], ngrid))
+        (iy0, iy1) = (_cell(np.minimum(ya, yb), box[2], size[1], ngrid), 
+                      _cell(np.maximum(ya, yb), box[2], size[1], ngrid))
+        for e in range(len(xa)):
+            cells[iy0[e]:iy1[e] + 1, ix0[e]:ix1[e] + 1] = 2
+        grid = (ngrid, size, cells.ravel())
+
+        index = (box, grid, slabs)
+        self._edges = (key, index)
+        return index
+
+    def evaluate(self, get, out):
+        (box, (ngrid, size, cells), slabs) = self._edge_index()
+        x = get(self.channel1)
+        y = get(self.channel2)
+        np.greater_equal(x, box[0], out = out)
+        out &= (x <= box[1])
+        out &= (y >= box[2])
+        out &= (y <= box[3])
+        candidates = np.flatnonzero(out)
+        if len(candidates) == 0:
+            return
+
+        x = x[candidates].astype(np.float64)
+        y = y[candidates].astype(np.float64)
+        cell = _cell(y, box[2], size[1], ngrid)
+        cell *= ngrid
+        cell += _cell(x, box[0], size[0], ngrid)
+        state = cells.take(cell)
+        inside = (state == 1)
+        edge = np.flatnonzero(state == 2)
+        inside[edge] = _crossings(x[edge], y[edge], box[2], slabs)
+        out[candidates] = inside
+
+    def expression(self, names, constants):
+        return None
+
+    def __str__(self):
+        return 'Polygon({}, {}) with {} vertices'.format(self.channel1, self.channel2, len(self.vertices))
+
+def _cell_size(low, high, n):
+    size = (high - low)/n
+    return size if size > 0 else 1.
+
+def _cell(x, low, size, n):
+    """ Index of the cell of width size containing x, of n starting at low."""
+    cell = ((x - low)/size).astype(np.intp)
+    return np.clip(cell, 0, n - 1, out = cell)
+
+def _crossings(x, y, ymin, slabs):
+    """ Parity of the number of polygon edges crossed by rays to the right of
+        the points (x, y); see GatePolygon._edge_index for slabs.
+    """
+    (height, nslabs, width, table) = slabs
+    slab = _cell(y, ymin, height, nslabs)
+    slab *= width
+    inside = np.zeros(len(x), dtype = bool)
+    for k in range(width):
+        ya = table[1].take(slab)
+        yb = table[2].take(slab)
+        cross = (ya > y) != (yb > y)
+        cross &= x < table[0].take(slab) + (y - ya)*table[3].take(slab)
+        inside ^= cross
+        slab += 1
+    return inside
+
+
+class GateAnd(GateVirtual):
+    """ Events selected by every one of the given gates."""
+    _operator = '&'
+
+    def __init__(self, *gates):
+        self.gates = list(gates)
+
+    def key(self):
+        return (self._operator, tuple(g.key() for g in self.gates))
+
+    def channels(self):
+        return [c for g in self.gates for c in g.channels()]
+
+    def evaluate(self, get, out):
+        self.gates[0].evaluate(get, out)
+        if len(self.gates) > 1:
+            tmp = np.empty_like(out)
+            for g in self.gates[1:]:
+                g.evaluate(get, tmp)
+                self._combine(out, tmp)
+
+    def _combine(self, out, tmp):
+        np.logical_and(out, tmp, out = out)
+
+    def expression(self, names, constants):
+        expressions = [g.expression(names, constants) for g in self.gates]
+        if None in expressions:
+            return None
+        return '(' + (' ' + self._operator + ' ').join(expressions) + ')'
+
+    def __str__(self):
+        return '(' + (' ' + self._operator + ' ').join(str(g) for g in self.gates) + ')'
+
+
+class GateOr(GateAnd):
+    """ Events selected by any of the given gates."""
+    _operator = '|'
+
+    def _combine(self, out, tmp):
+        np.logical_or(out, tmp, out = out)
+
+
+class GateNot(GateVirtual):
+    """ Events not selected by the given gate."""
+    def __init__(self, gate):
+        self.gate = gate
+
+    def key(self):
+        return ('not', self.gate.key())
+
+    def channels(self):
+        return self.gate.channels()
+
+    def evaluate(self, get, out):
+        self.gate.evaluate(get, out)
+        np.logical_not(out, out = out)
+
+    def expression(self, names, constants):
+        expression = self.gate.expression(names, constants)
+        if expression is None:
+            return None
+        return '(~' + expression + ')'
+
+    def __str__(self):
+        return '~' + str(self.gate)
@@ -8,13 +8,33 @@ static char module_docstring[] =
     "This provides a C implementation of the kde module for kernel density estimation.";
 static char hat_linear_docstring[] =
     "Linear hat kernel density estimator on a linear grid";
+static char linear_binning_docstring[] =
+    "Linearly binned counts of the data on a linear grid";
+static char hat_linear_batch_docstring[] =
+    "Linear hat kernel density estimators of several channels of a matrix for several populations of events";
+static char kernel2_linear_docstring[] =
+    "Two dimensional product hat or gaussian kernel density estimator on a uniform grid";
+static char linear_binning2_docstring[] =
+    "Bilinearly binned counts of two dimensional data on a uniform grid";
+static char kernel_linear_docstring[] =
+    "Kernel density estimator on a linear grid with a gaussian, epanechnikov, biweight or triweight kernel";
 
 /* Available functions */
 static PyObject *kde_hat_linear(PyObject *self, PyObject *args);
+static PyObject *kde_linear_binning(PyObject *self, PyObject *args);
+static PyObject *kde_kernel_linear(PyObject *self, PyObject *args);
+static PyObject *kde_hat_linear_batch(PyObject *self, PyObject *args);
+static PyObject *kde_kernel2_linear(PyObject *self, PyObject *args);
+static PyObject *kde_linear_binning2(PyObject *self, PyObject *args);
 
 /* Module specification */
 static PyMethodDef module_methods[] = {
     {"hat_linear", kde_hat_linear, METH_VARARGS, hat_linear_docstring},
+    {"linear_binning", kde_linear_binning, METH_VARARGS, linear_binning_docstring},
+    {"kernel_linear", kde_kernel_linear, METH_VARARGS, kernel_linear_docstring},
+    {"hat_linear_batch", kde_hat_linear_batch, METH_VARARGS, hat_linear_batch_docstring},
+    {"kernel2_linear", kde_kernel2_linear, METH_VARARGS, kernel2_linear_docstring},
+    {"linear_binning2", kde_linear_binning2, METH_VARARGS, linear_binning2_docstring},
     {NULL, NULL, 0, NULL}
 };
 
@@ -31,8 +51,30 @@ PyMODINIT_FUNC init_kde(void)
 
 /* From here on, we define interfaces to objects in our module */
 
+/* Returns 0 with a ValueError set unless both axes of a 2D grid have at
+ * least two points. */
+static int check_grid2(const int *npoints)
+{
+    if (npoints[0] < 2 || npoints[1] < 2) {
+        PyErr_SetString(PyExc_ValueError, "A grid needs at least two points along each axis");
+        return 0;
+    }
+    return 1;
+}
+
+/* Returns result, or raises MemoryError if the C code could not allocate
+ * its buffers (status -1) */
+static PyObject *check_status(int status, PyObject *result)
+{
+    if (status != 0) {
+        Py_DECREF(result);
+        return PyErr_NoMemory();
+    }
+    return result;
+}
+
 /* _kde.hat_linear expects 
- * data (*double)
+ * data (*double or *float; single precision arrays are used without copying)
  * bandwidth (double)
  * xmin (double)
  * xmax (double)
@@ -52,8 +94,10 @@ static PyObject *kde_hat_linear(PyObject *self, PyObject *args)
                                          &npoints))
         return NULL;
 
-    /* Interpret the input objects as numpy arrays. */
-    PyObject *data_array = PyArray_FROM_OTF(data_obj, NPY_DOUBLE, NPY_IN_ARRAY);
+    /* Interpret the input objects as numpy arrays, keeping single precision
+     * data as it is rather than converting it to double. */
+    int single = PyArray_Check(data_obj) && PyArray_TYPE((PyArrayObject *) data_obj) == NPY_FLOAT;
+    PyObject *data_array = PyArray_FROM_OTF(data_obj, single ? NPY_FLOAT : NPY_DOUBLE, NPY_IN_ARRAY);
 
     /* If that didn't work, throw an exception. */
     if (data_array == NULL ) {
@@ -64,23 +108,341 @@ static PyObject *kde_hat_linear(PyObject *self, PyObject *args)
     /* How many data points are there? */
     int N = (int)PyArray_DIM(data_array, 0);
 
-    /* Get pointers to the data as C-types. */
-    double *data = (double*)PyArray_DATA(data_array);
-
     /* Initialize data for output. */
     npy_intp size = npoints;
     PyObject *den_obj = PyArray_SimpleNew(1, &size, NPY_DOUBLE);
+    if (den_obj == NULL) {
+        Py_DECREF(data_array);
+        return NULL;
+    }
     double *density = (double*) PyArray_DATA(den_obj);
 
     for(int j = 0; j < npoints; ++j)
 	    density[j] = 0.0;
     /* Call the external C function to compute the chi-squared. */
-    hat_linear(data, N, density, bandwidth, xmin, xmax, npoints);
+    /* The computation only touches arrays we hold references to, so other
+     * Python threads may run meanwhile. */
+    int status;
+    Py_BEGIN_ALLOW_THREADS
+    if (single)
+        status = hat_linear_float((float*)PyArray_DATA(data_array), N, density, bandwidth, xmin, xmax, npoints);
+    else
+        status = hat_linear((double*)PyArray_DATA(data_array), N, density, bandwidth, xmin, xmax, npoints);
+    Py_END_ALLOW_THREADS
 
     /* Clean up. */
     Py_DECREF(data_array);
 
 
     /* Build the output tuple */
-    return den_obj;
+    return check_status(status, den_obj);
+}
+
+/* _kde.linear_binning expects 
+ * data (*double or *float)
+ * xmin (double)
+ * xmax (double)
+ * npoints (int)
+ *
+ * returns:
+ * counts (*double) 
+ */
+static PyObject *kde_linear_binning(PyObject *self, PyObject *args)
+{
+    double xmin, xmax;
+    int npoints;
+    PyObject *data_obj;
+
+    if (!PyArg_ParseTuple(args, "Oddi", &data_obj, &xmin, &xmax, &npoints))
+        return NULL;
+
+    int single = PyArray_Check(data_obj) && PyArray_TYPE((PyArrayObject *) data_obj) == NPY_FLOAT;
+    PyObject *data_array = PyArray_FROM_OTF(data_obj, single ? NPY_FLOAT : NPY_DOUBLE, NPY_IN_ARRAY);
+    if (data_array == NULL)
+        return NULL;
+
+    int N = (int)PyArray_DIM(data_array, 0);
+
+    npy_intp size = npoints;
+    PyObject *counts_obj = PyArray_ZEROS(1, &size, NPY_DOUBLE, 0);
+    if (counts_obj == NULL) {
+        Py_DECREF(data_array);
+        return NULL;
+    }
+    double *counts = (double*) PyArray_DATA(counts_obj);
+
+    int status;
+    Py_BEGIN_ALLOW_THREADS
+    if (single)
+        status = linear_binning_float((float*)PyArray_DATA(data_array), N, counts, xmin, xmax, npoints);
+    else
+        status = linear_binning((double*)PyArray_DATA(data_array), N, counts, xmin, xmax, npoints);
+    Py_END_ALLOW_THREADS
+
+    Py_DECREF(data_array);
+    return check_status(status, counts_obj);
+}
+
+/* _kde.kernel_linear expects 
+ * data (*double or *float)
+ * kernel (string: gaussian, epanechnikov, biweight or triweight)
+ * bandwidth (double)
+ * xmin (double)
+ * xmax (double)
+ * npoints (int)
+ *
+ * returns:
+ * den (*double) 
+ */
+static PyObject *kde_kernel_linear(PyObject *self, PyObject *args)
+{
+    double xmin, xmax, bandwidth;
+    int npoints;
+    const char *kernel_name;
+    PyObject *data_obj;
+
+    if (!PyArg_ParseTuple(args, "Osdddi", &data_obj, &kernel_name, &bandwidth, &xmin, &xmax,
+                                          &npoints))
+        return NULL;
+
+    int kernel = kernel_index(kernel_name);
+    if (kernel < 0) {
+        PyErr_Format(PyExc_ValueError, "Unknown kernel %s", kernel_name);
+        return NULL;
+    }
+
+    int single = PyArray_Check(data_obj) && PyArray_TYPE((PyArrayObject *) data_obj) == NPY_FLOAT;
+    PyObject *data_array = PyArray_FROM_OTF(data_obj, single ? NPY_FLOAT : NPY_DOUBLE, NPY_IN_ARRAY);
+    if (data_array == NULL)
+        return NULL;
+
+    int N = (int)PyArray_DIM(data_array, 0);
+
+    npy_intp size = npoints;
+    PyObject *den_obj = PyArray_ZEROS(1, &size, NPY_DOUBLE, 0);
+    if (den_obj == NULL) {
+        Py_DECREF(data_array);
+        return NULL;
+    }
+    double *density = (double*) PyArray_DATA(den_obj);
+
+    int status;
+    Py_BEGIN_ALLOW_THREADS
+    status = kernel_linear(PyArray_DATA(data_array), single, N, density, kernel, bandwidth, xmin, xmax, npoints);
+    Py_END_ALLOW_THREADS
+
+    Py_DECREF(data_array);
+    return check_status(status, den_obj);
+}
+
+/* _kde.hat_linear_batch expects 
+ * matrix (2D *double or *float, with any strides)
+ * rows (*int, nchannels rows of matrix)
+ * masks (2D *bool, npopulations by the number of columns of matrix)
+ * bandwidth (*double, one per channel)
+ * xmin (*double, one per channel)
+ * xmax (*double, one per channel)
+ * npoints (int)
+ *
+ * returns:
+ * den (*double, nchannels by npopulations by npoints) 
+ */
+static PyObject *kde_hat_linear_batch(PyObject *self, PyObject *args)
+{
+    int npoints, c;
+    PyObject *matrix_obj, *rows_obj, *masks_obj, *bandwidth_obj, *xmin_obj, *xmax_obj;
+    PyObject *matrix = NULL, *rows = NULL, *masks = NULL, *bandwidth = NULL, *xmin = NULL, *xmax = NULL;
+    PyObject *den_obj = NULL;
+
+    if (!PyArg_ParseTuple(args, "OOOOOOi", &matrix_obj, &rows_obj, &masks_obj, &bandwidth_obj,
+                                           &xmin_obj, &xmax_obj, &npoints))
+        return NULL;
+
+    /* The matrix is used with its own strides, so channel-major, event-major
+     * and memory-mapped matrices are all read in place */
+    int single = PyArray_Check(matrix_obj) && PyArray_TYPE((PyArrayObject *) matrix_obj) == NPY_FLOAT;
+    matrix = PyArray_FROM_OTF(matrix_obj, single ? NPY_FLOAT : NPY_DOUBLE, NPY_ALIGNED);
+    rows = PyArray_FROM_OTF(rows_obj, NPY_INT, NPY_IN_ARRAY);
+    masks = PyArray_FROM_OTF(masks_obj, NPY_BOOL, NPY_IN_ARRAY);
+    bandwidth = PyArray_FROM_OTF(bandwidth_obj, NPY_DOUBLE, NPY_IN_ARRAY);
+    xmin = PyArray_FROM_OTF(xmin_obj, NPY_DOUBLE, NPY_IN_ARRAY);
+    xmax = PyArray_FROM_OTF(xmax_obj, NPY_DOUBLE, NPY_IN_ARRAY);
+    if (matrix == NULL || rows == NULL || masks == NULL || bandwidth == NULL || xmin == NULL || xmax == NULL)
+        goto fail;
+
+    if (PyArray_NDIM(matrix) != 2 || PyArray_NDIM(masks) != 2 || PyArray_NDIM(rows) != 1) {
+        PyErr_SetString(PyExc_ValueError, "matrix and masks must be two dimensional and rows one dimensional");
+        goto fail;
+    }
+    int N = (int)PyArray_DIM(matrix, 1);
+    int nchannels = (int)PyArray_DIM(rows, 0);
+    int npopulations = (int)PyArray_DIM(masks, 0);
+    if (PyArray_DIM(masks, 1) != N) {
+        PyErr_SetString(PyExc_ValueError, "masks must have one entry per column of matrix");
+        goto fail;
+    }
+    if (PyArray_SIZE(bandwidth) != nchannels || PyArray_SIZE(xmin) != nchannels || PyArray_SIZE(xmax) != nchannels) {
+        PyErr_SetString(PyExc_ValueError, "bandwidth, xmin and xmax must have one entry per channel");
+        goto fail;
+    }
+    int *row = (int*) PyArray_DATA(rows);
+    for (c = 0; c < nchannels; ++c)
+        if (row[c] < 0 || row[c] >= PyArray_DIM(matrix, 0)) {
+            PyErr_SetString(PyExc_IndexError, "row out of range");
+            goto fail;
+        }
+
+    npy_intp dims[3] = {nchannels, npopulations, npoints};
+    den_obj = PyArray_ZEROS(3, dims, NPY_DOUBLE, 0);
+    if (den_obj == NULL)
+        goto fail;
+
+    npy_intp itemsize = PyArray_ITEMSIZE(matrix);
+    int status;
+    Py_BEGIN_ALLOW_THREADS
+    status = hat_linear_batch(PyArray_DATA(matrix), single, PyArray_STRIDE(matrix, 0)/itemsize, 
+            PyArray_STRIDE(matrix, 1)/itemsize, N, row, nchannels, 
+            (unsigned char*) PyArray_DATA(masks), npopulations, (double*) PyArray_DATA(bandwidth), 
+            (double*) PyArray_DATA(xmin), (double*) PyArray_DATA(xmax), npoints, 
+            (double*) PyArray_DATA(den_obj));
+    Py_END_ALLOW_THREADS
+
+    Py_DECREF(matrix);
+    Py_DECREF(rows);
+    Py_DECREF(masks);
+    Py_DECREF(bandwidth);
+    Py_DECREF(xmin);
+    Py_DECREF(xmax);
+    return check_status(status, den_obj);
+
+fail:
+    Py_XDECREF(matrix);
+    Py_XDECREF(rows);
+    Py_XDECREF(masks);
+    Py_XDECREF(bandwidth);
+    Py_XDECREF(xmin);
+    Py_XDECREF(xmax);
+    Py_XDECREF(den_obj);
+    return NULL;
+}
+
+/* Interprets x and y as arrays of the same length and precision, which is
+ * single if both are float arrays; returns 0 on failure with an exception
+ * set. */
+static int xy_arrays(PyObject *x_obj, PyObject *y_obj, PyObject **x, PyObject **y, int *single)
+{
+    *single = PyArray_Check(x_obj) && PyArray_TYPE((PyArrayObject *) x_obj) == NPY_FLOAT &&
+              PyArray_Check(y_obj) && PyArray_TYPE((PyArrayObject *) y_obj) == NPY_FLOAT;
+    *x = PyArray_FROM_OTF(x_obj, *single ? NPY_FLOAT : NPY_DOUBLE, NPY_IN_ARRAY);
+    *y = PyArray_FROM_OTF(y_obj, *single ? NPY_FLOAT : NPY_DOUBLE, NPY_IN_ARRAY);
+    if (*x == NULL || *y == NULL) {
+        Py_XDECREF(*x);
+        Py_XDECREF(*y);
+        return 0;
+    }
+    if (PyArray_SIZE(*x) != PyArray_SIZE(*y)) {
+        PyErr_SetString(PyExc_ValueError, "x and y must have the same length");
+        Py_DECREF(*x);
+        Py_DECREF(*y);
+        return 0;
+    }
+    return 1;
+}
+
+/* _kde.kernel2_linear expects 
+ * x, y (*double or *float)
+ * kernel (string: hat or gaussian)
+ * bandwidth (tuple of two doubles)
+ * xrange (tuple of two doubles: xmin, xmax)
+ * yrange (tuple of two doubles: ymin, ymax)
+ * npoints (tuple of two ints: nx, ny)
+ *
+ * returns:
+ * den (*double, nx by ny) 
+ */
+static PyObject *kde_kernel2_linear(PyObject *self, PyObject *args)
+{
+    double bandwidth[2], low[2], high[2];
+    int npoints[2];
+    const char *kernel_name;
+    PyObject *x_obj, *y_obj, *x, *y;
+    int single;
+
+    if (!PyArg_ParseTuple(args, "OOs(dd)(dd)(dd)(ii)", &x_obj, &y_obj, &kernel_name, 
+                          &bandwidth[0], &bandwidth[1], &low[0], &high[0], &low[1], &high[1],
+                          &npoints[0], &npoints[1]))
+        return NULL;
+
+    int kernel = kernel2_index(kernel_name);
+    if (kernel < 0) {
+        PyErr_Format(PyExc_ValueError, "Unknown kernel %s", kernel_name);
+        return NULL;
+    }
+    if (!check_grid2(npoints))
+        return NULL;
+    if (!xy_arrays(x_obj, y_obj, &x, &y, &single))
+        return NULL;
+
+    int N = (int)PyArray_SIZE(x);
+    npy_intp dims[2] = {npoints[0], npoints[1]};
+    PyObject *den_obj = PyArray_ZEROS(2, dims, NPY_DOUBLE, 0);
+    if (den_obj == NULL) {
+        Py_DECREF(x);
+        Py_DECREF(y);
+        return NULL;
+    }
+
+    int status;
+    Py_BEGIN_ALLOW_THREADS
+    status = kernel2_linear(PyArray_DATA(x), PyArray_DATA(y), single, N, (double*) PyArray_DATA(den_obj),
+            kernel, bandwidth, low, high, npoints);
+    Py_END_ALLOW_THREADS
+
+    Py_DECREF(x);
+    Py_DECREF(y);
+    return check_status(status, den_obj);
+}
+
+/* _kde.linear_binning2 expects 
+ * x, y (*double or *float)
+ * xrange (tuple of two doubles: xmin, xmax)
+ * yrange (tuple of two doubles: ymin, ymax)
+ * npoints (tuple of two ints: nx, ny)
+ *
+ * returns:
+ * counts (*double, nx by ny) 
+ */
+static PyObject *kde_linear_binning2(PyObject *self, PyObject *args)
+{
+    double low[2], high[2];
+    int npoints[2];
+    PyObject *x_obj, *y_obj, *x, *y;
+    int single;
+
+    if (!PyArg_ParseTuple(args, "OO(dd)(dd)(ii)", &x_obj, &y_obj, &low[0], &high[0], 
+                          &low[1], &high[1], &npoints[0], &npoints[1]))
+        return NULL;
+    if (!check_grid2(npoints))
+        return NULL;
+    if (!xy_arrays(x_obj, y_obj, &x, &y, &single))
+        return NULL;
+
+    int N = (int)PyArray_SIZE(x);
+    npy_intp dims[2] = {npoints[0], npoints[1]};
+    PyObject *counts_obj = PyArray_ZEROS(2, dims, NPY_DOUBLE, 0);
+    if (counts_obj == NULL) {
+        Py_DECREF(x);
+        Py_DECREF(y);
+        return NULL;
+    }
+
+    int status;
+    Py_BEGIN_ALLOW_THREADS
+    status = linear_binning2(PyArray_DATA(x), PyArray_DATA(y), single, N, (double*) PyArray_DATA(counts_obj),
+            low, high, npoints);
+    Py_END_ALLOW_THREADS
+
+    Py_DECREF(x);
+    Py_DECREF(y);
+    return check_status(status, counts_obj);
 }
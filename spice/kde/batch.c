@@ -0,0 +1,116 @@
+#include "kde.h"
+#include "math.h"
+#include <stdlib.h>
+
+/* Hat kernel density estimates of several channels of a matrix for several
+ * populations of its events at once.  Each event is read once: the 
+ * populations containing it are found from the masks, and then for each 
+ * channel the kernel weights on the grid points within its window are 
+ * computed once and added to the row of every one of those populations.
+ */
+
+struct batch {
+	ptrdiff_t row_stride;
+	ptrdiff_t column_stride;
+	int N;
+	const int *rows;
+	int nchannels;
+	const unsigned char *masks;
+	int npopulations;
+	const double *bandwidth;
+	const double *xmin;
+	const double *h;
+	int npoints;
+};
+
+static void hat_linear_batch_accumulate(const void *data, int single, int start, int stop, double *density,
+		const void *params) {
+	const struct batch *batch = params;
+	int npopulations = batch->npopulations;
+	int npoints = batch->npoints;
+	int bottom, top;
+	int c, j, k, m, count;
+	ptrdiff_t offset;
+	double x, w, bandwidth, xmin, h;
+	double *row;
+	/* Populations containing the current event */
+	int members[npopulations];
+
+	for(j = start; j < stop; ++j){
+		count = 0;
+		for(m = 0; m < npopulations; ++m)
+			if(batch->masks[(size_t) m*batch->N + j])
+				members[count++] = m;
+		if(count == 0)
+			continue;
+
+		for(c = 0; c < batch->nchannels; ++c){
+			offset = batch->rows[c]*batch->row_stride + j*batch->column_stride;
+			x = single ? ((const float*) data)[offset] : ((const double*) data)[offset];
+			bandwidth = batch->bandwidth[c];
+			xmin = batch->xmin[c];
+			h = batch->h[c];
+
+			bottom = (int) ceil( (x - bandwidth - xmin)/h);
+			if(bottom<0)
+				bottom=0;
+			top = (int) floor( (x + bandwidth -xmin)/h);
+			if(top > npoints - 1)
+				top = npoints -1;
+
+			row = density + (size_t) c*npopulations*npoints;
+			for(k = bottom; k <= top; ++k){
+				w = 1 - fabs(x - (k*h + xmin))/bandwidth;
+				for(m = 0; m < count; ++m)
+					row[(size_t) members[m]*npoints + k] += w;
+			}
+		}
+	}
+}
+
+/* data is a matrix with N columns (events), where entry (i, j) is at offset
+ * i*row_stride + j*column_stride; masks is npopulations by N.  The density of
+ * channel rows[c] in population m is written to 
+ * density[(c*npopulations + m)*npoints:...], normalized by the number of 
+ * events in the population, on the grid of npoints from xmin[c] to xmax[c].
+ *
+ * Returns 0 on success and -1 if memory could not be allocated.
+ */
+int hat_linear_batch(const void *data, int single, ptrdiff_t row_stride, ptrdiff_t column_stride,
+		int N, const int *rows, int nchannels, const unsigned char *masks, int npopulations,
+		const double *bandwidth, const double *xmin, const double *xmax, int npoints, double *density) {
+	int c, j, k, m;
+	int status;
+	double scale;
+	double *h = malloc(nchannels*sizeof(double));
+	long *counts = calloc(npopulations, sizeof(long));
+	if(h == NULL || counts == NULL){
+		free(h);
+		free(counts);
+		return -1;
+	}
+
+	for(c = 0; c < nchannels; ++c)
+		h[c] = (xmax[c] - xmin[c])/(npoints - 1);
+	for(m = 0; m < npopulations; ++m)
+		for(j = 0; j < N; ++j)
+			counts[m] += masks[(size_t) m*N + j] != 0;
+
+	struct batch batch = {row_stride, column_stride, N, rows, nchannels, masks, npopulations,
+		bandwidth, xmin, h, npoints};
+	status = parallel_accumulate(hat_linear_batch_accumulate, data, single, N, density,
+			nchannels*npopulations*npoints, &batch);
+
+	for(c = 0; c < nchannels && status == 0; ++c)
+		for(m = 0; m < npopulations; ++m){
+			if(counts[m] == 0)
+				continue;
+			scale = 1/(bandwidth[c]*counts[m]);
+			for(k = 0; k < npoints; ++k)
+				density[((size_t) c*npopulations + m)*npoints + k] *= scale;
+		}
+
+	free(h);
+	free(counts);
+	return status;
+}
@@ -0,0 +1,45 @@
+#include "kde.h"
+#include "math.h"
+
+/* Linear binning: each data point splits a unit weight between the two grid
+ * points on either side of it, in proportion to its distance from the other.
+ * Points outside [xmin, xmax] are dropped.  This is a single O(N) pass, after 
+ * which a kernel density estimate is a convolution of the counts with the 
+ * kernel sampled on the grid.
+ */
+
+static void linear_binning_accumulate(const void *data, int single, int start, int stop, double *counts,
+		const void *params) {
+	const struct grid *grid = params;
+	int j, k;
+	double x, pos, frac;
+	int npoints = grid->npoints;
+
+	for(j = start; j < stop; ++j){
+		x = single ? ((const float*) data)[j] : ((const double*) data)[j];
+		pos = (x - grid->xmin)/grid->h;
+		if(!(pos >= 0) || pos > npoints - 1)
+			continue;
+		k = (int) pos;
+		if(k == npoints - 1){
+			counts[k] += 1;
+			continue;
+		}
+		frac = pos - k;
+		counts[k] += 1 - frac;
+		counts[k+1] += frac;
+	}
+}
+
+static int linear_binning_data(const void *data, int single, int N, double *counts, double xmin, double xmax, int npoints) {
+	struct grid grid = {N, 0, xmin, (xmax - xmin)/(npoints - 1), npoints, 0};
+	return parallel_accumulate(linear_binning_accumulate, data, single, N, counts, npoints, &grid);
+}
+
+int linear_binning(double *data, int N, double *counts, double xmin, double xmax, int npoints) {
+	return linear_binning_data(data, 0, N, counts, xmin, xmax, npoints);
+}
+
+int linear_binning_float(float *data, int N, double *counts, double xmin, double xmax, int npoints) {
+	return linear_binning_data(data, 1, N, counts, xmin, xmax, npoints);
+}
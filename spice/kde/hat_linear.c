@@ -5,26 +5,50 @@
 /* NB: The current implementation is O(# of data points) because we determine the window of which points are actually
  * affected by the sparse kernel.  
  *
+ * Events are split across threads; see parallel_accumulate.
  */
 
-void hat_linear(double *data, int N, double *density, double bandwidth, double xmin, double xmax, int npoints) {
+static void hat_linear_accumulate(const void *data, int single, int start, int stop, double *density,
+		const void *params) {
+	const struct grid *grid = params;
 	int bottom, top;
 	int j,k;
-	double xgrid;
-	double h = (xmax - xmin)/(npoints - 1);
+	double x, xgrid;
+	double bandwidth = grid->bandwidth;
+	double xmin = grid->xmin;
+	double h = grid->h;
+	int npoints = grid->npoints;
 
-	for(j = 0; j< N; ++j){
-		bottom = (int) ceil( (data[j] - bandwidth - xmin)/h);
+	for(j = start; j < stop; ++j){
+		x = single ? ((const float*) data)[j] : ((const double*) data)[j];
+		bottom = (int) ceil( (x - bandwidth - xmin)/h);
 		if(bottom<0)
 			bottom=0;
 
-		top = (int) floor( (data[j] + bandwidth -xmin)/h);
+		top = (int) floor( (x + bandwidth -xmin)/h);
 		if(top > npoints - 1)
 			top = npoints -1;
 
 		for(k = bottom; k <= top; ++k){
 			xgrid = k*h + xmin;
-			density[k] += (1 - ( fabs(data[j] - xgrid)/bandwidth))/(bandwidth*N);
+			density[k] += (1 - ( fabs(x - xgrid)/bandwidth))/(bandwidth*grid->N);
 		}
 	}
 }
+
+static int hat_linear_data(const void *data, int single, int N, double *density, double bandwidth, 
+		double xmin, double xmax, int npoints) {
+	struct grid grid = {N, bandwidth, xmin, (xmax - xmin)/(npoints - 1), npoints, 0};
+	return parallel_accumulate(hat_linear_accumulate, data, single, N, density, npoints, &grid);
+}
+
+int hat_linear(double *data, int N, double *density, double bandwidth, double xmin, double xmax, int npoints) {
+	return hat_linear_data(data, 0, N, density, bandwidth, xmin, xmax, npoints);
+}
+
+/* As hat_linear, for single precision data; the density is still accumulated
+ * in double precision.
+ */
+int hat_linear_float(float *data, int N, double *density, double bandwidth, double xmin, double xmax, int npoints) {
+	return hat_linear_data(data, 1, N, density, bandwidth, xmin, xmax, npoints);
+}
@@ -1 +1,47 @@
-void hat_linear(double *data, int N, double *density, double bandwidth, double xmin, double xmax, int npoints);
+#include <stddef.h>
+
+/* A uniform grid of npoints from xmin with spacing h, and the parameters of
+ * the estimate being accumulated on it; N is the total number of data 
+ * points, used to normalize the density.
+ */
+struct grid {
+	int N;
+	double bandwidth;
+	double xmin;
+	double h;
+	int npoints;
+	int kernel;
+};
+
+/* Adds the contribution of data points start to stop (float if single is 
+ * nonzero, double otherwise) to out; params is, e.g., a struct grid */
+typedef void (*accumulate_fn)(const void *data, int single, int start, int stop, double *out,
+		const void *params);
+int parallel_accumulate(accumulate_fn accumulate, const void *data, int single, int N,
+		double *out, int nout, const void *params);
+
+int hat_linear(double *data, int N, double *density, double bandwidth, double xmin, double xmax, int npoints);
+int hat_linear_float(float *data, int N, double *density, double bandwidth, double xmin, double xmax, int npoints);
+int linear_binning(double *data, int N, double *counts, double xmin, double xmax, int npoints);
+int linear_binning_float(float *data, int N, double *counts, double xmin, double xmax, int npoints);
+
+#define KERNEL_GAUSSIAN 0
+#define KERNEL_EPANECHNIKOV 1
+#define KERNEL_BIWEIGHT 2
+#define KERNEL_TRIWEIGHT 3
+#define KERNEL_HAT 4
+/* Standard deviations at which the gaussian kernel is truncated */
+#define GAUSSIAN_SUPPORT 4.0
+int kernel_index(const char *name);
+int kernel_linear(const void *data, int single, int N, double *density, int kernel,
+		double bandwidth, double xmin, double xmax, int npoints);
+
+int hat_linear_batch(const void *data, int single, ptrdiff_t row_stride, ptrdiff_t column_stride,
+		int N, const int *rows, int nchannels, const unsigned char *masks, int npopulations,
+		const double *bandwidth, const double *xmin, const double *xmax, int npoints, double *density);
+
+int kernel2_index(const char *name);
+int kernel2_linear(const void *x, const void *y, int single, int N, double *density, int kernel,
+		const double *bandwidth, const double *xmin, const double *xmax, const int *npoints);
+int linear_binning2(const void *x, const void *y, int single, int N, double *counts,
+		const double *xmin, const double *xmax, const int *npoints);
@@ -57,7 +57,7 @@ def hat_linear(data, bandwidth = 1.0, xmin = None, xmax = None, npoints = 100, c
             den = _kde.hat_linear(data, bandwidth, xmin, xmax, npoints)
         except:
             # If the C code fails, default to slow python code
-            den = hat_linear(data, bandwidth, xmin, xmax, points, code = 'python')
+            den = hat_linear(data, bandwidth, xmin, xmax, npoints, code = 'python')
     elif code == 'python':
 
         h = (xmax - xmin)/(npoints - 1)
@@ -73,3 +73,238 @@ def hat_linear(data, bandwidth = 1.0, xmin = None, xmax = None, npoints = 100, c
         raise ValueError('Code type {} not allowed'.format(code))
 
     return den
+
+def hat_bandwidth(data):
+    """ Silverman's rule of thumb, 0.9 min(sd, IQR/1.34) N**(-1/5), scaled by
+    sqrt(6) to the half-width of the hat kernel with the same variance as the
+    gaussian kernel the rule was derived for.  Falls back to the standard 
+    deviation if the IQR is zero, and to 1 for constant data.
+    """
+    data = np.asarray(data)
+    sd = float(np.std(data, dtype = np.float64))
+    (q1, q3) = np.percentile(data, [25, 75])
+    spread = min(sd, (q3 - q1)/1.34) if q3 > q1 else sd
+    if not spread > 0:
+        return 1.0
+    return np.sqrt(6)*0.9*spread*len(data)**-0.2
+
+def hat_linear_batch(matrix, channels, masks = None, bandwidth = 1.0, xmin = None, xmax = None, npoints = 100):
+    """ Hat kernel density estimates of several channels (rows) of matrix for
+    several populations of its events (columns) in one pass over the events
+    Parameters
+    ----------
+    matrix : numpy array (two dimensional)
+        Channels by events; it is read in place whatever its strides.
+
+    channels : list of integers
+        Rows of matrix to estimate densities of.
+
+    masks : numpy array (two dimensional boolean) or None
+        One row per population marking its events; None for all events.
+
+    bandwidth, xmin, xmax : float, list of floats or None
+        Bandwidth and range of the grid of each channel, or one value for
+        all.  Where None, the minimum and maximum of the channel are used,
+        and the bandwidth given by hat_bandwidth for all of its events.
+
+    npoints : positive integer
+        Number of grid points inclusive of the end points
+
+    Returns
+    -------
+    den : numpy array
+        den[i, j] is the density of channels[i] in population j, normalized
+        by the number of events in that population, on the grid from 
+        xmin[i] to xmax[i].
+    """
+    channels = np.asarray(channels, dtype = np.intc)
+    if masks is None:
+        masks = np.ones((1, matrix.shape[1]), dtype = bool)
+    masks = np.atleast_2d(masks)
+
+    def per_channel(values, default):
+        if values is None:
+            values = [default(matrix[c]) for c in channels]
+        return np.broadcast_to(np.asarray(values, dtype = np.float64), channels.shape).copy()
+
+    return _kde.hat_linear_batch(matrix, channels, masks, per_channel(bandwidth, hat_bandwidth), 
+            per_channel(xmin, np.min), per_channel(xmax, np.max), npoints)
+
+def kernel_linear(data, kernel = 'gaussian', bandwidth = 1.0, xmin = None, xmax = None, npoints = 100):
+    """ A Kernel density estimate on a linear grid using one of the kernels
+    gaussian (where bandwidth is the standard deviation, truncated at four),
+    epanechnikov, biweight or triweight.  As with hat_linear, each data point
+    only touches the grid points within its window.  Other parameters are as
+    for hat_linear.
+    """
+    if xmin is None:
+        xmin = np.min(data)
+    if xmax is None:
+        xmax = np.max(data)
+    return _kde.kernel_linear(data, kernel, bandwidth, float(xmin), float(xmax), npoints)
+
+# Kernels as functions of u = (x - x_j)/bandwidth with unit integral, and
+# the |u| beyond which they vanish (or are truncated)
+_kernels = {
+    'hat': (1., lambda u: np.maximum(1 - np.abs(u), 0)),
+    'gaussian': (4., lambda u: np.exp(-0.5*u**2)/np.sqrt(2*np.pi)),
+    'epanechnikov': (1., lambda u: 0.75*np.maximum(1 - u**2, 0)),
+    'biweight': (1., lambda u: 0.9375*np.maximum(1 - u**2, 0)**2),
+    'triweight': (1., lambda u: 1.09375*np.maximum(1 - u**2, 0)**3),
+    }
+
+# Kernels with at most this many points are convolved directly, longer ones
+# by FFT
+_direct_convolution = 64
+
+def binned(data, bandwidth = 1.0, xmin = None, xmax = None, npoints = 100, kernel = 'hat'):
+    """ A binned kernel density estimate on a linear grid
+
+    The data are linearly binned onto the grid in a single pass (in C), and
+    the counts convolved with the kernel sampled on the grid, so that the 
+    cost is O(N) plus O(npoints log npoints) independent of the bandwidth.
+    The grid is extended by the width of the kernel on either side while
+    binning, so data outside [xmin, xmax] still contributes.  The result
+    approximates hat_linear with an error of order (grid spacing/bandwidth)**2.
+    A kernel wider than the grid would need an extended grid as wide as 
+    itself, so is evaluated directly instead.
+
+    Parameters are as for hat_linear; kernel is hat or one of the kernels
+    of kernel_linear.
+    """
+    if kernel not in _kernels:
+        raise ValueError('Unknown kernel {}'.format(kernel))
+    if xmin is None:
+        xmin = np.min(data)
+    if xmax is None:
+        xmax = np.max(data)
+    xmin = float(xmin)
+    xmax = float(xmax)
+    if not xmax > xmin:
+        raise ValueError('xmax must be greater than xmin')
+
+    h = (xmax - xmin)/(npoints - 1)
+    # Grid points within the support of the kernel
+    (support, K) = _kernels[kernel]
+    width = int(floor(support*bandwidth/h))
+    if width > npoints:
+        if kernel == 'hat':
+            return hat_linear(data, bandwidth, xmin, xmax, npoints)
+        return kernel_linear(data, kernel, bandwidth, xmin, xmax, npoints)
+    counts = _kde.linear_binning(data, xmin - width*h, xmax + width*h, npoints + 2*width)
+    weights = K(np.arange(-width, width + 1)*h/bandwidth)/bandwidth
+
+    den = _convolve(counts, weights)[width:width + npoints]
+    return den/len(data)
+
+def _convolve(counts, weights, axis = -1):
+    """ Convolution of counts along axis with the odd length weights, 
+        centered so the result is the same shape as counts.
+    """
+    counts = np.moveaxis(counts, axis, -1)
+    n = counts.shape[-1]
+    width = len(weights)//2
+    if len(weights) <= _direct_convolution:
+        if counts.ndim == 1:
+            out = np.convolve(counts, weights, 'same')
+        else:
+            # Sum of shifted copies, vectorized over the other axes
+            padded = np.zeros(counts.shape[:-1] + (n + 2*width,))
+            padded[..., width:width + n] = counts
+            out = np.zeros(counts.shape)
+            for (k, w) in enumerate(weights):
+                out += w*padded[..., 2*width - k:2*width - k + n]
+    else:
+        # Pad to a power of two for a fast transform
+        nfft = 2**int(ceil(np.log2(n + len(weights) - 1)))
+        full = np.fft.irfft(np.fft.rfft(counts, nfft)*np.fft.rfft(weights, nfft), nfft)
+        # Round off can leave tiny negative densities
+        out = np.maximum(full[..., width:width + n], 0)
+    return np.moveaxis(out, -1, axis)
+
+def _grid_range(data, low, high):
+    low = float(np.min(data) if low is None else low)
+    high = float(np.max(data) if high is None else high)
+    if not high > low:
+        raise ValueError('The upper end of the grid must be greater than the lower')
+    return (low, high)
+
+def _grid_npoints(npoints):
+    npoints = tuple(int(n) for n in npoints)
+    if len(npoints) != 2 or min(npoints) < 2:
+        raise ValueError('A grid needs at least two points along each axis; you gave {}'.format(npoints))
+    return npoints
+
+def kernel2_linear(x, y, kernel = 'hat', bandwidth = (1.0, 1.0), xmin = None, xmax = None,
+        ymin = None, ymax = None, npoints = (100, 100)):
+    """ A two dimensional kernel density estimate on a uniform grid
+    Parameters
+    ----------
+    x, y : numpy arrays (one dimensional)
+        Coordinates of the data.
+
+    kernel : 'hat' or 'gaussian'
+        The kernel is the product of this kernel in x and in y; for the 
+        gaussian the bandwidths are standard deviations.
+
+    bandwidth : pair of floats
+        Bandwidths in x and y.
+
+    xmin, xmax, ymin, ymax : float or None
+        Range of the grid.  If none, the minimum or maximum of the data.
+
+    npoints : pair of positive integers
+        Number of grid points in x and y, inclusive of the end points
+
+    Returns
+    -------
+    den : numpy array
+        npoints[0] by npoints[1] array where den[i, j] is the density at
+        the i-th x and j-th y grid point.
+
+    Each data point only touches the grid points within its window, so the
+    cost is O(N (bandwidth/grid spacing)**2); see binned2 for wide 
+    bandwidths.
+    """
+    npoints = _grid_npoints(npoints)
+    return _kde.kernel2_linear(x, y, kernel, tuple(float(b) for b in bandwidth), 
+            _grid_range(x, xmin, xmax), _grid_range(y, ymin, ymax), npoints)
+
+def binned2(x, y, bandwidth = (1.0, 1.0), xmin = None, xmax = None, ymin = None, ymax = None,
+        npoints = (100, 100), kernel = 'hat'):
+    """ A binned two dimensional kernel density estimate on a uniform grid
+
+    The data are bilinearly binned onto the grid in a single pass (in C), and
+    the counts convolved with the product kernel one axis at a time, so the
+    cost is O(N) plus that of the convolutions, independent of the bandwidth.
+    As with binned, the grid is extended by the width of the kernel while
+    binning, and hat and gaussian kernels wider than the grid are evaluated
+    directly; other kernels that wide raise ValueError, as their padded grid
+    could not be allocated.  Parameters are as for kernel2_linear, but kernel
+    may be any of the kernels of binned.
+    """
+    if kernel not in _kernels:
+        raise ValueError('Unknown kernel {}'.format(kernel))
+    if len(x) == 0:
+        raise ValueError('Require nonempty data')
+    npoints = _grid_npoints(npoints)
+    (support, K) = _kernels[kernel]
+    ranges = [_grid_range(x, xmin, xmax), _grid_range(y, ymin, ymax)]
+    h = [(high - low)/(n - 1) for ((low, high), n) in zip(ranges, npoints)]
+    # Grid points within the support of the kernel on each axis
+    width = [int(floor(support*b/step)) for (b, step) in zip(bandwidth, h)]
+    if width[0] > npoints[0] or width[1] > npoints[1]:
+        if kernel not in ('hat', 'gaussian'):
+            raise ValueError('Bandwidth too wide for the grid with kernel {}'.format(kernel))
+        return kernel2_linear(x, y, kernel, bandwidth, ranges[0][0], ranges[0][1], 
+                ranges[1][0], ranges[1][1], npoints)
+    extended = [(low - w*step, high + w*step) for ((low, high), w, step) in zip(ranges, width, h)]
+    counts = _kde.linear_binning2(x, y, extended[0], extended[1], 
+            (npoints[0] + 2*width[0], npoints[1] + 2*width[1]))
+
+    den = counts
+    for axis in range(2):
+        weights = K(np.arange(-width[axis], width[axis] + 1)*h[axis]/bandwidth[axis])/bandwidth[axis]
+        den = _convolve(den, weights, axis)
+        den = np.take(den, np.arange(width[axis], width[axis] + npoints[axis]), axis = axis)
+    return den/len(x)
@@ -0,0 +1,158 @@
+#include "kde.h"
+#include "math.h"
+#include <string.h>
+
+/* Two dimensional kernel density estimates on a uniform nx by ny grid using
+ * product kernels K(u) K(v); den[i, j] is stored at den[i*ny + j].  As in 
+ * hat_linear, each data point only touches the grid points within its 
+ * window, and points are split across threads with parallel_accumulate.
+ */
+
+struct grid2 {
+	const void *x;
+	const void *y;
+	int N;
+	double bandwidth[2];
+	double xmin[2];
+	double h[2];
+	int npoints[2];
+	int kernel;
+};
+
+static double kernel2(int kernel, double u) {
+	if(kernel == KERNEL_GAUSSIAN)
+		return exp(-0.5*u*u)*0.3989422804014327;
+	u = fabs(u);
+	return u < 1 ? 1 - u : 0;
+}
+
+int kernel2_index(const char *name) {
+	if(strcmp(name, "hat") == 0)
+		return KERNEL_HAT;
+	if(strcmp(name, "gaussian") == 0)
+		return KERNEL_GAUSSIAN;
+	return -1;
+}
+
+/* The window of grid points along axis d within radius of x, and the 
+ * kernel weights there; returns the number of points */
+static int window(const struct grid2 *grid, int d, double x, double radius, int *bottom, double *w) {
+	int k, top;
+	double h = grid->h[d];
+	double xmin = grid->xmin[d];
+
+	*bottom = (int) ceil( (x - radius - xmin)/h);
+	if(*bottom < 0)
+		*bottom = 0;
+	top = (int) floor( (x + radius - xmin)/h);
+	if(top > grid->npoints[d] - 1)
+		top = grid->npoints[d] - 1;
+
+	for(k = *bottom; k <= top; ++k)
+		w[k - *bottom] = kernel2(grid->kernel, (x - (k*h + xmin))/grid->bandwidth[d]);
+	return top - *bottom + 1;
+}
+
+static void kernel2_accumulate(const void *data, int single, int start, int stop, double *density,
+		const void *params) {
+	const struct grid2 *grid = params;
+	int ny = grid->npoints[1];
+	double wx[grid->npoints[0]], wy[ny];
+	double support = grid->kernel == KERNEL_GAUSSIAN ? GAUSSIAN_SUPPORT : 1.0;
+	int j, i, k, bx, by, nwx, nwy;
+	double x, y;
+	double *row;
+
+	for(j = start; j < stop; ++j){
+		x = single ? ((const float*) grid->x)[j] : ((const double*) grid->x)[j];
+		y = single ? ((const float*) grid->y)[j] : ((const double*) grid->y)[j];
+		nwx = window(grid, 0, x, support*grid->bandwidth[0], &bx, wx);
+		if(nwx <= 0)
+			continue;
+		nwy = window(grid, 1, y, support*grid->bandwidth[1], &by, wy);
+		for(i = 0; i < nwx; ++i){
+			row = density + (size_t) (bx + i)*ny + by;
+			for(k = 0; k < nwy; ++k)
+				row[k] += wx[i]*wy[k];
+		}
+	}
+}
+
+/* Returns 0 on success and -1 if memory could not be allocated. */
+int kernel2_linear(const void *x, const void *y, int single, int N, double *density, int kernel,
+		const double *bandwidth, const double *xmin, const double *xmax, const int *npoints) {
+	int d, k;
+	int status;
+	double scale;
+	struct grid2 grid;
+
+	grid.x = x;
+	grid.y = y;
+	grid.N = N;
+	grid.kernel = kernel;
+	for(d = 0; d < 2; ++d){
+		grid.bandwidth[d] = bandwidth[d];
+		grid.xmin[d] = xmin[d];
+		grid.h[d] = (xmax[d] - xmin[d])/(npoints[d] - 1);
+		grid.npoints[d] = npoints[d];
+	}
+	status = parallel_accumulate(kernel2_accumulate, x, single, N, density, npoints[0]*npoints[1], &grid);
+
+	if(N > 0){
+		scale = 1/(bandwidth[0]*bandwidth[1]*N);
+		for(k = 0; k < npoints[0]*npoints[1]; ++k)
+			density[k] *= scale;
+	}
+	return status;
+}
+
+/* Bilinear binning: each point splits a unit weight among the four grid 
+ * points around it; points outside the grid are dropped.  The grid must
+ * have at least two points along each axis. */
+static void linear_binning2_accumulate(const void *data, int single, int start, int stop, double *counts,
+		const void *params) {
+	const struct grid2 *grid = params;
+	int nx = grid->npoints[0], ny = grid->npoints[1];
+	int j, kx, ky;
+	double px, py, fx, fy;
+	double *cell;
+
+	for(j = start; j < stop; ++j){
+		px = ((single ? ((const float*) grid->x)[j] : ((const double*) grid->x)[j]) - grid->xmin[0])/grid->h[0];
+		py = ((single ? ((const float*) grid->y)[j] : ((const double*) grid->y)[j]) - grid->xmin[1])/grid->h[1];
+		if(!(px >= 0) || px > nx - 1 || !(py >= 0) || py > ny - 1)
+			continue;
+		/* Points on the upper edges go in the last cell */
+		kx = (int) px;
+		if(kx == nx - 1)
+			kx = nx - 2;
+		ky = (int) py;
+		if(ky == ny - 1)
+			ky = ny - 2;
+		fx = px - kx;
+		fy = py - ky;
+		cell = counts + (size_t) kx*ny + ky;
+		cell[0] += (1 - fx)*(1 - fy);
+		cell[1] += (1 - fx)*fy;
+		cell[ny] += fx*(1 - fy);
+		cell[ny + 1] += fx*fy;
+	}
+}
+
+int linear_binning2(const void *x, const void *y, int single, int N, double *counts,
+		const double *xmin, const double *xmax, const int *npoints) {
+	int d;
+	struct grid2 grid;
+
+	grid.x = x;
+	grid.y = y;
+	grid.N = N;
+	grid.kernel = KERNEL_HAT;
+	for(d = 0; d < 2; ++d){
+		grid.bandwidth[d] = 0;
+		grid.xmin[d] = xmin[d];
+		grid.h[d] = (xmax[d] - xmin[d])/(npoints[d] - 1);
+		grid.npoints[d] = npoints[d];
+	}
+	return parallel_accumulate(linear_binning2_accumulate, x, single, N, counts, npoints[0]*npoints[1], &grid);
+}
@@ -0,0 +1,96 @@
+#include "kde.h"
+#include "math.h"
+#include <string.h>
+
+/* Kernels other than the hat, as functions of u = (x - x_j)/bandwidth with
+ * unit integral.  The Gaussian is truncated at GAUSSIAN_SUPPORT standard 
+ * deviations (losing less than 1e-4 of its mass) so that, as in hat_linear,
+ * each data point only touches the grid points within its window.
+ */
+
+static double gaussian(double u) {
+	return exp(-0.5*u*u)*0.3989422804014327;
+}
+
+/* The polynomial kernels are clipped at zero, since round off can place a
+ * grid point just outside the window */
+static double epanechnikov(double u) {
+	double v = 1 - u*u;
+	return v > 0 ? 0.75*v : 0;
+}
+
+static double biweight(double u) {
+	double v = 1 - u*u;
+	return v > 0 ? 0.9375*v*v : 0;
+}
+
+static double triweight(double u) {
+	double v = 1 - u*u;
+	return v > 0 ? 1.09375*v*v*v : 0;
+}
+
+int kernel_index(const char *name) {
+	if(strcmp(name, "gaussian") == 0)
+		return KERNEL_GAUSSIAN;
+	if(strcmp(name, "epanechnikov") == 0)
+		return KERNEL_EPANECHNIKOV;
+	if(strcmp(name, "biweight") == 0)
+		return KERNEL_BIWEIGHT;
+	if(strcmp(name, "triweight") == 0)
+		return KERNEL_TRIWEIGHT;
+	return -1;
+}
+
+static void kernel_linear_accumulate(const void *data, int single, int start, int stop, double *density,
+		const void *params) {
+	const struct grid *grid = params;
+	int bottom, top;
+	int j,k;
+	double x, u;
+	double bandwidth = grid->bandwidth;
+	double xmin = grid->xmin;
+	double h = grid->h;
+	int npoints = grid->npoints;
+	double radius = bandwidth;
+	double (*K)(double);
+
+	switch(grid->kernel){
+		case KERNEL_GAUSSIAN:
+			K = gaussian;
+			radius = GAUSSIAN_SUPPORT*bandwidth;
+			break;
+		case KERNEL_EPANECHNIKOV:
+			K = epanechnikov;
+			break;
+		case KERNEL_BIWEIGHT:
+			K = biweight;
+			break;
+		default:
+			K = triweight;
+	}
+
+	for(j = start; j < stop; ++j){
+		x = single ? ((const float*) data)[j] : ((const double*) data)[j];
+		bottom = (int) ceil( (x - radius - xmin)/h);
+		if(bottom<0)
+			bottom=0;
+
+		top = (int) floor( (x + radius -xmin)/h);
+		if(top > npoints - 1)
+			top = npoints -1;
+
+		for(k = bottom; k <= top; ++k){
+			u = (x - (k*h + xmin))/bandwidth;
+			density[k] += K(u)/(bandwidth*grid->N);
+		}
+	}
+}
+
+/* Density on the grid of the kernel given by kernel_index; data is float if
+ * single is nonzero and double otherwise.
+ */
+int kernel_linear(const void *data, int single, int N, double *density, int kernel,
+		double bandwidth, double xmin, double xmax, int npoints) {
+	struct grid grid = {N, bandwidth, xmin, (xmax - xmin)/(npoints - 1), npoints, kernel};
+	return parallel_accumulate(kernel_linear_accumulate, data, single, N, density, npoints, &grid);
+}
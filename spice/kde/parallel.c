@@ -0,0 +1,52 @@
+#include <stdlib.h>
+#include "kde.h"
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
+/* Fewer events than this are not worth starting threads for */
+#define PARALLEL_MIN_EVENTS 100000
+
+/* Splits the N data points into one contiguous block per OpenMP thread, each
+ * accumulated into a private copy of the nout outputs, which are summed into
+ * out at the end; this avoids both locking and false sharing.  Without
+ * OpenMP, or for small N, everything is accumulated directly into out.
+ *
+ * Returns 0 on success and -1 if the buffers could not be allocated.
+ */
+int parallel_accumulate(accumulate_fn accumulate, const void *data, int single, int N,
+		double *out, int nout, const void *params) {
+	int nthreads = 1;
+	int t, k;
+	double *buffers;
+
+#ifdef _OPENMP
+	if(N >= PARALLEL_MIN_EVENTS)
+		nthreads = omp_get_max_threads();
+#endif
+	if(nthreads <= 1){
+		accumulate(data, single, 0, N, out, params);
+		return 0;
+	}
+
+	buffers = calloc((size_t) nthreads*nout, sizeof(double));
+	if(buffers == NULL)
+		return -1;
+
+#ifdef _OPENMP
+	#pragma omp parallel num_threads(nthreads)
+	{
+		int thread = omp_get_thread_num();
+		int count = omp_get_num_threads();
+		int start = (int) ((long long) N*thread/count);
+		int stop = (int) ((long long) N*(thread + 1)/count);
+		accumulate(data, single, start, stop, buffers + (size_t) thread*nout, params);
+	}
+#endif
+
+	for(t = 0; t < nthreads; ++t)
+		for(k = 0; k < nout; ++k)
+			out[k] += buffers[(size_t) t*nout + k];
+	free(buffers);
+	return 0;
+}
@@ -1,8 +1,16 @@
+import os
 from distutils.core import setup, Extension
 import numpy.distutils.misc_util
 
 #c_ext = Extension("_kde", ["_kde.c", "hat_linear.c"],libraries=['m','],library_dirs=['/usr/local/lib'])
-c_ext = Extension("_kde", ["_kde.c", "hat_linear.c"],libraries = ['m'])
+# Events are split across threads with OpenMP; set SPICE_NO_OPENMP to build
+# without it (e.g., with compilers lacking -fopenmp)
+if os.environ.get('SPICE_NO_OPENMP'):
+    openmp = []
+else:
+    openmp = ['-fopenmp']
+c_ext = Extension("_kde", ["_kde.c", "hat_linear.c", "binning.c", "kernels.c", "parallel.c", "batch.c", "kde2.c"],
+        libraries = ['m'], extra_compile_args = openmp, extra_link_args = openmp)
 
 setup(
     ext_modules=[c_ext],
@@ -40,5 +40,149 @@ class TestCKDE(unittest.TestCase):
         self.assertTrue(np.linalg.norm(den - den2,np.inf)<1e-13)
 
 
+class TestSinglePrecision(unittest.TestCase):
+    def test_hat_linear_float(self):
+        data = np.random.rand(10000)
+        den = _kde.hat_linear(data, 0.1, 0., 1., 101)
+        den2 = _kde.hat_linear(data.astype(np.float32), 0.1, 0., 1., 101)
+        self.assertTrue(np.linalg.norm(den - den2, np.inf) < 1e-5)
+        # Strided single precision arrays are copied, not misread
+        den3 = _kde.hat_linear(data.astype(np.float32)[::2], 0.1, 0., 1., 101)
+        den4 = _kde.hat_linear(data[::2], 0.1, 0., 1., 101)
+        self.assertTrue(np.linalg.norm(den3 - den4, np.inf) < 1e-5)
+
+
+class TestBinned(unittest.TestCase):
+    def setUp(self):
+        self.data = np.random.randn(20000)
+
+    def test_linear_binning(self):
+        counts = _kde.linear_binning(np.array([0., 0.25, 1., 2., -1.]), 0., 1., 3)
+        self.assertTrue(np.allclose(counts, [1.5, 0.5, 1.]))
+        counts = _kde.linear_binning(self.data.astype(np.float32), -2., 2., 101)
+        self.assertAlmostEqual(np.sum(counts), np.sum(np.abs(self.data) <= 2), 3)
+
+    def test_binned(self):
+        # Both the direct and FFT convolutions, and data beyond the grid
+        for bandwidth in [0.2, 1.]:
+            den = _kde.hat_linear(self.data, bandwidth, -2., 2., 201)
+            den2 = kde.binned(self.data, bandwidth, -2., 2., 201)
+            self.assertTrue(np.linalg.norm(den - den2, np.inf) < 1e-3*np.max(den))
+        self.assertRaises(ValueError, kde.binned, self.data, 1., 0., 0.)
+        # Kernels wider than the grid are evaluated directly
+        den = kde.binned(self.data, 1e6, -2., 2., 201, 'epanechnikov')
+        self.assertTrue(np.allclose(den, kde.kernel_linear(self.data, 'epanechnikov', 1e6, -2., 2., 201)))
+
+
+class TestKernels(unittest.TestCase):
+    def setUp(self):
+        self.data = np.random.randn(10000)
+
+    def test_kernel_linear(self):
+        grid = np.linspace(-6, 6, 601)
+        for kernel in ['gaussian', 'epanechnikov', 'biweight', 'triweight']:
+            den = kde.kernel_linear(self.data, kernel, 0.3, -6, 6, 601)
+            # Each kernel has unit integral
+            self.assertAlmostEqual(np.sum(den)*(grid[1] - grid[0]), 1., 3)
+            den2 = kde.kernel_linear(self.data.astype(np.float32), kernel, 0.3, -6, 6, 601)
+            self.assertTrue(np.linalg.norm(den - den2, np.inf) < 1e-5)
+            den3 = kde.binned(self.data, 0.3, -6, 6, 601, kernel)
+            self.assertTrue(np.linalg.norm(den - den3, np.inf) < 5e-3*np.max(den))
+        # A single point at zero gives the kernel itself
+        den = kde.kernel_linear(np.zeros(1), 'epanechnikov', 2., -2, 2, 5)
+        self.assertTrue(np.allclose(den, np.array([0, 0.75*0.75, 0.75, 0.75*0.75, 0])/2))
+        self.assertRaises(ValueError, kde.kernel_linear, self.data, 'box')
+
+
+class TestThreaded(unittest.TestCase):
+    def setUp(self):
+        # Large enough to be split across threads
+        self.data = np.random.randn(300000)
+
+    def test_parallel_sum(self):
+        # Halves are small enough to be computed serially
+        (a, b) = (self.data[:150000], self.data[150000:])
+        den = _kde.hat_linear(self.data, 0.2, -4., 4., 401)
+        den2 = (_kde.hat_linear(a, 0.2, -4., 4., 401) + _kde.hat_linear(b, 0.2, -4., 4., 401))/2
+        self.assertTrue(np.linalg.norm(den - den2, np.inf) < 1e-12)
+        counts = _kde.linear_binning(self.data.astype(np.float32), -4., 4., 401)
+        counts2 = _kde.linear_binning(a.astype(np.float32), -4., 4., 401) + \
+                  _kde.linear_binning(b.astype(np.float32), -4., 4., 401)
+        self.assertTrue(np.linalg.norm(counts - counts2, np.inf) < 1e-9)
+
+    def test_python_threads(self):
+        # The GIL is released, so several estimates can run concurrently
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(4)
+        try:
+            dens = pool.map(lambda k: kde.kernel_linear(self.data, 'gaussian', 0.1*k, -4., 4., 401), [1, 2, 3, 4])
+        finally:
+            pool.close()
+            pool.join()
+        for (k, den) in zip([1, 2, 3, 4], dens):
+            self.assertTrue(np.allclose(den, kde.kernel_linear(self.data, 'gaussian', 0.1*k, -4., 4., 401)))
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.matrix = np.random.randn(4, 5000).astype(np.float32)
+        self.masks = np.random.rand(3, 5000) < np.array([[0.5], [0.1], [1.]])
+
+    def test_hat_linear_batch(self):
+        den = kde.hat_linear_batch(self.matrix, [3, 1], self.masks, [0.2, 0.5], -3, [3, 4], 101)
+        self.assertEqual(den.shape, (2, 3, 101))
+        for (i, (c, bandwidth, xmax)) in enumerate([(3, 0.2, 3.), (1, 0.5, 4.)]):
+            for (j, mask) in enumerate(self.masks):
+                ref = _kde.hat_linear(self.matrix[c][mask], bandwidth, -3., xmax, 101)
+                self.assertTrue(np.linalg.norm(den[i, j] - ref, np.inf) < 1e-9)
+        # Any memory layout is read in place
+        den2 = kde.hat_linear_batch(np.asfortranarray(self.matrix), [3, 1], self.masks, [0.2, 0.5], -3, [3, 4], 101)
+        self.assertTrue(np.array_equal(den, den2))
+        den = kde.hat_linear_batch(self.matrix, [0], npoints = 51)
+        ref = _kde.hat_linear(self.matrix[0], 1., float(np.min(self.matrix[0])), float(np.max(self.matrix[0])), 51)
+        self.assertTrue(np.allclose(den[0, 0], ref))
+        # The default bandwidth of each channel
+        den = kde.hat_linear_batch(self.matrix, [0, 2], bandwidth = None, npoints = 51)
+        for (i, c) in enumerate([0, 2]):
+            x = self.matrix[c]
+            ref = _kde.hat_linear(x, kde.hat_bandwidth(x), float(np.min(x)), float(np.max(x)), 51)
+            self.assertTrue(np.allclose(den[i, 0], ref))
+        self.assertTrue(abs(kde.hat_bandwidth(np.random.randn(100000)) - 0.22) < 0.01)
+        self.assertEqual(kde.hat_bandwidth(np.ones(10)), 1.)
+        self.assertRaises(IndexError, kde.hat_linear_batch, self.matrix, [4], self.masks, 1., 0, 1)
+        self.assertRaises(ValueError, kde.hat_linear_batch, self.matrix, [0], self.masks[:, :10], 1., 0, 1)
+
+
+class TestKDE2(unittest.TestCase):
+    def setUp(self):
+        self.x = np.random.randn(20000)
+        self.y = 0.5*self.x + np.random.randn(20000)
+
+    def test_linear_binning2(self):
+        counts = _kde.linear_binning2(np.array([0., 1., 0.25]), np.array([0., 1., 0.5]), (0., 1.), (0., 1.), (2, 2))
+        self.assertTrue(np.allclose(counts, [[1.375, 0.375], [0.125, 1.125]]))
+
+    def test_kernel2_linear(self):
+        for kernel in ['hat', 'gaussian']:
+            den = kde.kernel2_linear(self.x, self.y, kernel, (0.6, 0.8), -6., 6., -6., 6., (121, 101))
+            self.assertEqual(den.shape, (121, 101))
+            self.assertAlmostEqual(np.sum(den)*0.1*0.12, 1., 2)
+            den2 = kde.binned2(self.x, self.y, (0.6, 0.8), -6., 6., -6., 6., (121, 101), kernel)
+            self.assertTrue(np.max(np.abs(den - den2)) < 1e-2*np.max(den))
+        self.assertRaises(ValueError, kde.kernel2_linear, self.x, self.y, 'triweight')
+        # Grids need two points along each axis
+        self.assertRaises(ValueError, kde.kernel2_linear, self.x, self.y, 'hat', (1., 1.), npoints = (1, 10))
+        self.assertRaises(ValueError, kde.binned2, self.x, self.y, (1., 1.), npoints = (10, 1))
+        self.assertRaises(ValueError, _kde.linear_binning2, self.x, self.y, (0., 1.), (0., 1.), (1, 5))
+        # No data, and kernels wider than the grid
+        empty = np.array([])
+        self.assertEqual(np.sum(_kde.kernel2_linear(empty, empty, 'hat', (1., 1.), (0., 1.), (0., 1.), (3, 3))), 0)
+        den = kde.binned2(self.x, self.y, (100., 100.), -1, 1, -1, 1, (11, 11), 'gaussian')
+        self.assertTrue(np.allclose(den, kde.kernel2_linear(self.x, self.y, 'gaussian', (100., 100.), 
+                -1, 1, -1, 1, (11, 11))))
+        for kernel in ['epanechnikov', 'biweight', 'triweight']:
+            self.assertRaises(ValueError, kde.binned2, self.x, self.y, (1e3, 1e3), -1, 1, -1, 1, (101, 101), kernel)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -26,6 +26,7 @@ from matplotlib.figure import Figure
 from flowdata import FlowData as FlowData
 from flowdata import FlowAnalysis as FlowAnalysis
 from flowdata import GateIndex, GateBound, GateTree
+from cache import FCSCache
 
 # Helper for GUI
 from monoicon import MonoIcon
@@ -142,6 +143,12 @@ class OneFrame(wx.Frame):
         self.tree.update()
         self.index = len(self.fa)-1
         self.update_tag_list()
+
+    def load_many(self, filenames):
+        self.fa.load_many(filenames)
+        self.tree.update()
+        self.index = len(self.fa)-1
+        self.update_tag_list()
     
     def load_dialog(self, event):
         dlg = wx.FileDialog(self, "Choose an FCS file", os.getcwd(), "", "*.fcs", wx.OPEN)
@@ -1115,14 +1122,21 @@ class App(wx.App):
     """ Stand alone version of the one dimensional view
     """
     def OnInit(self):
+        # Keep decoded copies of opened files so they reopen quickly, if a
+        # cache directory has been chosen
+        if 'SPICE_CACHE' in os.environ:
+            FlowData.cache = FCSCache(os.environ['SPICE_CACHE'])
         self.frame = OneFrame(parent=None, title="Histogram", size=(640,480)) 
 
         # Read in files from command line
         if len(sys.argv) != 1:
+            filenames = []
             for arg in sys.argv[1:]:
                 filename = os.path.join(os.getcwd(),arg)
                 if os.path.isfile(filename):
-                    self.frame.load(filename)
+                    filenames.append(filename)
+            if len(filenames) > 0:
+                self.frame.load_many(filenames)
 
 
         self.frame.SetDoubleBuffered(True)
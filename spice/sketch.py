@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+""" Mergeable quantile sketches of channels
+
+ A sketch summarizes a stream of values in O(k) space so that quantiles can be
+ estimated with a rank error of roughly n/k, following the KLL sketch of
+ Karnin, Lang and Liberty, "Optimal quantile approximation in streams" (2016).
+ Sketches of chunks of a file, or of different files, can be merged into a
+ sketch of their union.
+"""
+import numpy as np
+import fcs
+
+class KLL:
+    """ A KLL quantile sketch.
+
+        Values are kept in compactors, where each value in level h stands for
+        2**h values of the stream.  When a level exceeds its capacity it is
+        sorted and every other value, starting at random, is promoted to the
+        next level.  Large arrays are added a chunk at a time: each chunk is
+        sorted and sampled straight into the level where it fits, which is
+        the same as compacting it level by level.
+
+        The exact minimum and maximum are also kept.
+    """
+    def __init__(self, k = 200, seed = None):
+        self.k = k
+        self.n = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self._levels = [np.empty(0)]
+        self._random = np.random.RandomState(seed)
+        # Sorted values and cumulative weights, see _cdf
+        self._sorted = None
+
+    def __len__(self):
+        return self.n
+
+    def _capacity(self, h):
+        return max(2, int(np.ceil(self.k*(2./3)**(len(self._levels) - 1 - h))))
+
+    def update(self, x, chunk = 65536):
+        """ Add the values in the array x; NaNs are ignored."""
+        x = np.asarray(x).ravel()
+        if x.dtype.kind == 'f':
+            x = x[~np.isnan(x)]
+        if len(x) == 0:
+            return self
+        self.n += len(x)
+        self.min = min(self.min, float(np.min(x)))
+        self.max = max(self.max, float(np.max(x)))
+        for start in range(0, len(x), chunk):
+            values = x[start:start + chunk]
+            # Level where the chunk holds between k and 2k values
+            h = 0
+            while len(values) >= 2**(h + 1)*self.k:
+                h += 1
+            if h > 0:
+                values = np.sort(values)[self._random.randint(2**h)::2**h]
+            self._add(h, values.astype(np.float64))
+        return self
+
+    def merge(self, other):
+        """ Add the values summarized by the sketch other."""
+        if other.n == 0:
+            return self
+        self.n += other.n
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        for (h, values) in enumerate(other._levels):
+            self._add(h, values)
+        return self
+
+    def _add(self, h, values):
+        while len(self._levels) <= h:
+            self._levels.append(np.empty(0))
+        self._levels[h] = np.concatenate([self._levels[h], values])
+        self._sorted = None
+        self._compress()
+
+    def _compress(self):
+        h = 0
+        while h < len(self._levels):
+            values = self._levels[h]
+            if len(values) > self._capacity(h):
+                if h + 1 == len(self._levels):
+                    self._levels.append(np.empty(0))
+                values = np.sort(values)
+                # An odd value out stays behind
+                if len(values) % 2 == 1:
+                    (keep, values) = (values[:1], values[1:])
+                else:
+                    keep = values[:0]
+                promoted = values[self._random.randint(2)::2]
+                self._levels[h] = keep
+                self._levels[h + 1] = np.concatenate([self._levels[h + 1], promoted])
+            h += 1
+
+    def _cdf(self):
+        if self._sorted is None:
+            values = np.concatenate(self._levels)
+            weights = np.concatenate([np.full(len(v), 2.**h) for (h, v) in enumerate(self._levels)])
+            order = np.argsort(values, kind = 'mergesort')
+            self._sorted = (values[order], np.cumsum(weights[order]))
+        return self._sorted
+
+    def quantile(self, q):
+        """ Estimate of the q quantile(s) of the values, for q in [0, 1]."""
+        if self.n == 0:
+            raise ValueError('Quantiles of an empty sketch are not defined')
+        (values, weights) = self._cdf()
+        q = np.asarray(q, dtype = np.float64)
+        index = np.searchsorted(weights, q*weights[-1], side = 'left')
+        x = values[np.clip(index, 0, len(values) - 1)]
+        # The extremes are known exactly
+        x = np.where(q <= 0, self.min, np.where(q >= 1, self.max, x))
+        return x if x.ndim > 0 else float(x)
+
+    def rank(self, x):
+        """ Estimate of the fraction of values less than or equal to x."""
+        if self.n == 0:
+            raise ValueError('Ranks of an empty sketch are not defined')
+        (values, weights) = self._cdf()
+        index = np.searchsorted(values, x, side = 'right')
+        cdf = np.concatenate([[0.], weights])/weights[-1]
+        return cdf[index]
+
+def merge(sketches):
+    """ A new sketch of the union of the values summarized by sketches."""
+    sketches = list(sketches)
+    result = KLL(sketches[0].k if len(sketches) > 0 else 200)
+    for s in sketches:
+        result.merge(s)
+    return result
+
+def sketch_file(filename, k = 200, chunk_events = 65536, seed = None):
+    """ Sketches of each channel of the FCS file filename, built while
+        streaming its events with fcs.iter_events, so the file is never held
+        in memory.  If seed is given, channel j is sketched with seed + j.
+    """
+    sketches = None
+    for events in fcs.iter_events(filename, chunk_events):
+        if sketches is None:
+            sketches = [KLL(k, None if seed is None else seed + j) for j in range(events.shape[0])]
+        for (s, x) in zip(sketches, events):
+            s.update(x)
+    return sketches if sketches is not None else []
@@ -23,7 +23,7 @@ print fa.gate_tree
 
 fd_new = t.gate([fd])
 
-print fd._data.shape[1]
+print fd.data.shape[1]
 print fd.nevents
-print fd_new._data.shape[1]
+print fd_new.data.shape[1]
 print fd_new.nevents
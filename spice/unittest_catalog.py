@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import fcs
+import catalog
+
+class TestCatalog(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.archive = os.path.join(self.dir, 'archive')
+        os.makedirs(os.path.join(self.archive, 'day2'))
+        self.index = os.path.join(self.dir, 'index.json')
+        self.paths = [os.path.join(self.archive, 'a.fcs'), os.path.join(self.archive, 'day2', 'b.FCS')]
+        data = np.random.rand(2, 100).astype(np.float32)
+        for (j, path) in enumerate(self.paths):
+            fcs.save(path, data, {'$P1N': 'FSC', '$P2N': 'SSC', '$OP': 'Jos\xe9', 'sample': str(j)})
+        # Files that are not FCS are skipped
+        with open(os.path.join(self.archive, 'notes.txt'), 'w') as f:
+            f.write('notes')
+        with open(os.path.join(self.archive, 'broken.fcs'), 'w') as f:
+            f.write('not an FCS file')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_scan(self):
+        result = catalog.scan(self.archive, self.index)
+        self.assertEqual(sorted(result), sorted(self.paths))
+        metadata = result[self.paths[1]]
+        self.assertEqual(metadata['sample'], '1')
+        self.assertEqual(metadata['$TOT'], 100)
+        # Values that are not UTF-8 are read as latin-1
+        self.assertEqual(metadata['$OP'], u'Jos\xe9')
+        with open(self.index) as f:
+            self.assertEqual(sorted(json.load(f)), sorted(self.paths))
+
+    def test_rescan(self):
+        catalog.scan(self.archive, self.index)
+        # Unchanged files are taken from the index without being read
+        with open(self.index) as f:
+            entries = json.load(f)
+        entries[self.paths[0]]['metadata']['sample'] = 'from index'
+        with open(self.index, 'w') as f:
+            json.dump(entries, f)
+        result = catalog.scan(self.archive, self.index)
+        self.assertEqual(result[self.paths[0]]['sample'], 'from index')
+        # Removed files are dropped from the index
+        os.remove(self.paths[1])
+        result = catalog.scan(self.archive, self.index)
+        self.assertEqual(list(result), [self.paths[0]])
+        with open(self.index) as f:
+            self.assertEqual(list(json.load(f)), [self.paths[0]])
+
+
+if __name__ == '__main__':
+    unittest.main()
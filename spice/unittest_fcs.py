@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import fcs
+from cache import FCSCache
+
+class TestMmap(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'test.fcs')
+        self.data = np.random.rand(3, 500).astype(np.float32)*1000
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, byteorder):
+        """ Write self.data as a list mode float file by hand."""
+        (npar, ntot) = self.data.shape
+        text = '/$TOT/{}/$PAR/{}/$DATATYPE/F/$MODE/L/$BYTEORD/{}/'.format(ntot, npar,
+                '1,2,3,4' if byteorder == '<' else '4,3,2,1')
+        text += ''.join('$P{0}N/c{0}/$P{0}B/32/$P{0}R/1024/'.format(j + 1) for j in range(npar))
+        events = self.data.T.astype(np.dtype('float32').newbyteorder(byteorder))
+        data_start = 58 + len(text)
+        with open(self.path, 'wb') as f:
+            f.write('FCS3.0    {:8d}{:8d}{:8d}{:8d}{:8d}{:8d}'.format(58, data_start - 1,
+                    data_start, data_start + events.nbytes - 1, 0, 0))
+            f.write(text)
+            events.tofile(f)
+
+    def test_mmap(self):
+        for byteorder in ['<', '>']:
+            self.write(byteorder)
+            eager = fcs.read(self.path)[0]
+            mapped = fcs.read(self.path, mmap = True)[0]
+            self.assertTrue(isinstance(mapped, np.memmap))
+            self.assertEqual(mapped.shape, self.data.shape)
+            self.assertTrue(np.array_equal(mapped, eager))
+            self.assertTrue(np.array_equal(mapped, self.data))
+
+
+class TestFCS(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'test.fcs')
+        self.data = np.random.rand(4, 1000).astype(np.float32)*1000
+        self.metadata = {'$P1N': 'FSC', '$P2N': 'SSC', '$P3N': 'Ir/191', '$P4N': 'Time',
+                         '$P3S': 'DNA', '$CYT': 'test'}
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_save_read(self):
+        fcs.save(self.path, self.data, self.metadata, chunk_events = 300)
+        (data, metadata, analysis, meta_analysis) = fcs.read(self.path)
+        self.assertTrue(np.array_equal(data, self.data))
+        self.assertEqual(metadata['$TOT'], 1000)
+        self.assertEqual(metadata['$PAR'], 4)
+        self.assertEqual(metadata['$P2N'], 'SSC')
+        self.assertEqual(metadata['$P3N'], 'Ir/191')
+        self.assertEqual(metadata['$P1E'], (0.0, 0.0))
+
+    def test_save_index(self):
+        index = self.data[0] > 500
+        fcs.save(self.path, self.data, self.metadata, index = index, datatype = 'd')
+        (data, metadata, analysis, meta_analysis) = fcs.read(self.path)
+        self.assertEqual(data.dtype, np.float64)
+        self.assertTrue(np.array_equal(data, self.data[:,index]))
+
+    def test_mmap(self):
+        fcs.save(self.path, self.data, self.metadata)
+        (data, metadata, analysis, meta_analysis) = fcs.read(self.path, mmap = True)
+        self.assertTrue(isinstance(data, np.memmap))
+        self.assertTrue(np.array_equal(data, self.data))
+
+    def test_read_metadata(self):
+        fcs.save(self.path, self.data, self.metadata)
+        metadata = fcs.read_metadata(self.path)
+        self.assertEqual(metadata['$TOT'], 1000)
+        self.assertEqual(metadata['$P4N'], 'Time')
+
+    def test_iter_events(self):
+        fcs.save(self.path, self.data, self.metadata)
+        chunks = list(fcs.iter_events(self.path, chunk_events = 300))
+        self.assertEqual([x.shape[1] for x in chunks], [300, 300, 300, 100])
+        self.assertTrue(np.array_equal(np.hstack(chunks), self.data))
+
+    def test_read_mixed_integer(self):
+        # Build a big endian file with 16 and 32 bit channels by hand
+        data = (np.random.rand(3, 500)*4000).astype(np.uint32)
+        events = np.zeros(500, dtype = [('a', '>u2'), ('b', '>u4'), ('c', '>u2')])
+        for (j, name) in enumerate(events.dtype.names):
+            events[name] = data[j]
+        keywords = [('$TOT', 500), ('$PAR', 3), ('$DATATYPE', 'I'), ('$MODE', 'L'),
+                    ('$BYTEORD', '4,3,2,1'), ('$P1B', 16), ('$P2B', 32), ('$P3B', 16),
+                    ('$P1R', 1024), ('$P2R', 4096), ('$P3R', 1024)]
+        text = fcs._format_text(keywords)
+        data_start = 58 + len(text)
+        with open(self.path, 'wb') as f:
+            f.write('FCS3.0    {:8d}{:8d}{:8d}{:8d}{:8d}{:8d}'.format(58, data_start - 1,
+                    data_start, data_start + events.nbytes - 1, 0, 0))
+            f.write(text)
+            events.tofile(f)
+        (data2, metadata, analysis, meta_analysis) = fcs.read(self.path)
+        self.assertEqual(data2.dtype, np.float32)
+        self.assertTrue(np.array_equal(data2[0], data[0] & 1023))
+        self.assertTrue(np.array_equal(data2[1], data[1]))
+        self.assertTrue(np.array_equal(np.hstack(fcs.iter_events(self.path, 128)), data2))
+
+    def test_parse_text(self):
+        metadata = fcs._parse_text('|$p1n|FSC|$P1S|CD3||CD28|$P1B|16|custom|a||||b|')
+        self.assertEqual(metadata['$P1N'], 'FSC')
+        self.assertEqual(metadata['$P1S'], 'CD3|CD28')
+        self.assertEqual(metadata['custom'], 'a||b')
+        # Empty values
+        empty = fcs._parse_text('/$P1S//$P1N/FSC/$P2S//$P2N/SSC/')
+        self.assertEqual(empty, {'$P1S': '', '$P1N': 'FSC', '$P2S': '', '$P2N': 'SSC'})
+        fcs._convert_metadata(metadata)
+        self.assertEqual(metadata['$P1B'], 16)
+
+    def test_channels(self):
+        fcs.save(self.path, self.data, self.metadata)
+        table = fcs.channels(fcs.read_metadata(self.path))
+        self.assertEqual(len(table), 4)
+        self.assertEqual(table[2].name, 'Ir/191')
+        self.assertEqual(table[2].marker, 'DNA')
+        self.assertEqual(table[2].bits, 32)
+        self.assertEqual(table[0].gain, 1.0)
+
+    def test_cache(self):
+        fcs.save(self.path, self.data, self.metadata)
+        cache = FCSCache(os.path.join(self.dir, 'cache'))
+        (data1, metadata1, analysis, meta_analysis) = cache.read(self.path)
+        (data2, metadata2, analysis, meta_analysis) = cache.read(self.path)
+        self.assertTrue(isinstance(data2, np.memmap))
+        self.assertTrue(np.array_equal(data2, self.data))
+        self.assertEqual(metadata2['$P3N'], 'Ir/191')
+        (data3, metadata3, analysis, meta_analysis) = cache.read(self.path, mmap = False)
+        self.assertFalse(isinstance(data3, np.memmap))
+        self.assertTrue(np.array_equal(data3, self.data))
+        cache.max_bytes = 0
+        cache.evict()
+        self.assertEqual(os.listdir(cache.directory), [])
+
+    def test_spillover(self):
+        metadata = {'$SPILLOVER': '2,FSC,SSC,1,0.1,0.2,1'}
+        (names, matrix) = fcs.spillover(metadata)
+        self.assertEqual(names, ['FSC', 'SSC'])
+        self.assertTrue(np.array_equal(matrix, [[1, 0.1], [0.2, 1]]))
+        self.assertTrue(fcs.spillover({}) is None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import fcs
+import flowdata
+from flowdata import *
+import transform as transforms
+
+def save_uint64(path, data, names):
+    """ Write data as an FCS file of 64 bit integer channels, which fcs.save
+        does not write.
+    """
+    keywords = [('$TOT', data.shape[1]), ('$PAR', data.shape[0]), ('$DATATYPE', 'I'), 
+                ('$MODE', 'L'), ('$BYTEORD', '1,2,3,4')]
+    for (j, name) in enumerate(names):
+        keywords += [('$P{}N'.format(j + 1), name), ('$P{}B'.format(j + 1), 64), 
+                     ('$P{}R'.format(j + 1), 2**20)]
+    text = fcs._format_text(keywords)
+    events = np.ascontiguousarray(data.T, dtype = '<u8')
+    data_start = 58 + len(text)
+    with open(path, 'wb') as f:
+        f.write('FCS3.0    {:8d}{:8d}{:8d}{:8d}{:8d}{:8d}'.format(58, data_start - 1,
+                data_start, data_start + events.nbytes - 1, 0, 0))
+        f.write(text)
+        events.tofile(f)
+
+class TestFlowData(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'test.fcs')
+        self.data = np.random.rand(3, 1000)*100
+        self.metadata = {'$P1N': 'FSC', '$P2N': 'Nd142', '$P3N': 'Er167',
+                         '$P2S': 'CD19', '$P3S': 'CD3'}
+        fcs.save(self.path, self.data, self.metadata, datatype = 'd')
+        self.fd = FlowData(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_get(self):
+        self.assertTrue(np.array_equal(self.fd.get('Nd142'), self.data[1]))
+        self.assertTrue(np.array_equal(self.fd.CD3, self.data[2]))
+        self.assertRaises(AttributeError, self.fd.get, 'CD4')
+
+    def test_mangle(self):
+        self.metadata['$P1S'] = 'CD45 (Yb)'
+        fcs.save(self.path, self.data, self.metadata)
+        fd = FlowData(self.path)
+        self.assertTrue(np.allclose(fd.CD45_Yb, self.data[0]))
+        self.assertTrue(fd[fd.FSC > 50]._index is fd._index)
+
+    def test_compensate(self):
+        matrix = np.array([[1, 0.1], [0.05, 1]])
+        observed = self.data.copy()
+        observed[1:] = np.dot(matrix.T, self.data[1:])
+        self.fd._data = observed
+        self.fd.set_spillover(['Nd142', 'Er167'], matrix)
+        fd = self.fd.compensate(chunk_events = 300)
+        self.assertTrue(np.allclose(fd.data, self.data))
+        self.assertTrue(fd is self.fd.compensate())
+        # Daughters follow changes to the spillover matrix of the root
+        daughter = self.fd[self.fd.FSC > 50]
+        self.assertTrue(np.allclose(daughter.compensate().data, self.data[:, self.data[0] > 50]))
+        self.fd.set_spillover(['Nd142', 'Er167'], np.eye(2))
+        self.assertTrue(np.allclose(self.fd.compensate().data, observed))
+        self.assertTrue(daughter.spillover is self.fd.spillover)
+        self.assertTrue(np.allclose(daughter.compensate().data, observed[:, self.data[0] > 50]))
+        # Memory-mapped files are compensated a chunk at a time
+        fd = FlowData(self.path, mmap = True)
+        fd.set_spillover(['Nd142', 'Er167'], matrix)
+        self.assertTrue(np.allclose(fd.compensate(chunk_events = 300).data, 
+                np.vstack([self.data[0], np.linalg.solve(matrix.T, self.data[1:])])))
+
+    def test_transform(self):
+        x = self.fd.transform('CD19', 'arcsinh', 5)
+        self.assertTrue(np.allclose(x, np.arcsinh(self.data[1]/5)))
+        self.assertTrue(x is self.fd.transform('CD19', 'arcsinh', 5))
+        y = self.fd.transform('CD3', 'logicle', 1000., 0.5, 4.5, 0.)
+        self.assertTrue(np.allclose(transforms.logicle_inverse(y, 1000., 0.5, 4.5, 0.), self.data[2]))
+        (xgrid, den) = self.fd.kde1('CD19', 0.1, transform = ('arcsinh', 5))
+        self.assertAlmostEqual(xgrid[-1], np.max(x))
+        # 64 bit integer channels, which numexpr cannot read
+        counts = (self.data*10).astype(np.uint64)
+        save_uint64(self.path, counts, ['A', 'B', 'C'])
+        fd = FlowData(self.path)
+        self.assertEqual(fd.A.dtype, np.uint64)
+        self.assertTrue(np.allclose(fd.transform('A', 'arcsinh', 5), np.arcsinh(counts[0]/5.)))
+        self.assertTrue(np.allclose(fd.transform('B', 'log', 10), np.log10(np.maximum(counts[1], 10))))
+
+    def test_daughter(self):
+        fd = self.fd[self.fd.FSC > 50]
+        index = self.data[0] > 50
+        self.assertEqual(fd.nevents, np.sum(index))
+        self.assertEqual(self.fd.nevents, 1000)
+        self.assertTrue(fd._root is self.fd)
+        self.assertTrue(np.array_equal(fd.CD19, self.data[1, index]))
+        fd2 = fd[fd.CD19 < 50]
+        index = index & (self.data[1] < 50)
+        self.assertTrue(fd2._root is self.fd)
+        self.assertTrue(np.array_equal(fd2.data, self.data[:, index]))
+        # Only the most recently used channels are kept
+        fd2._daughter_columns = 2
+        for c in ['FSC', 'CD19', 'CD3', 'CD19']:
+            fd2.get(c)
+        self.assertEqual(list(fd2._columns), [2, 1])
+        for cofactor in [1, 2, 3, 1]:
+            fd2.transform('CD19', 'arcsinh', cofactor)
+        self.assertEqual(list(fd2._transformed), [(1, 'arcsinh', (3,)), (1, 'arcsinh', (1,))])
+        self.assertTrue(np.allclose(fd2.transform('CD19', 'arcsinh', 2), np.arcsinh(self.data[1, index]/2.)))
+        fd2.save(self.path, datatype = 'd')
+        self.assertTrue(np.array_equal(FlowData(self.path).data, self.data[:, index]))
+
+    def test_gate_cache(self):
+        fa = FlowAnalysis()
+        node = fa.append(self.fd)
+        t = GateTree()
+        t.gates = [GateBound('FSC', '>', 50)]
+        node.addChild(t)
+        u = GateTree()
+        u.gates = [GateBound('CD19', '<', 50)]
+        t.addChild(u)
+        fd = u.gate(fa.flow_data)
+        self.assertTrue(fd is u.gate(fa.flow_data))
+        parent = t.gate(fa.flow_data)
+        u.gates = [GateBound('CD19', '<', 25)]
+        self.assertTrue(t.gate(fa.flow_data) is parent)
+        self.assertEqual(u.gate(fa.flow_data).nevents,
+                np.sum((self.data[0] > 50) & (self.data[1] < 25)))
+        t.gates[0].bound = 75
+        self.assertEqual(u.gate(fa.flow_data).nevents,
+                np.sum((self.data[0] > 75) & (self.data[1] < 25)))
+
+    def test_gate_expression(self):
+        gate = (GateBound('FSC', '>', 50) & ~GateRange('CD19', 20, 40)) | GateCompare('CD3', '<', 'FSC')
+        (x, y, z) = self.data
+        index = ((x > 50) & ~((20 <= y) & (y <= 40))) | (z < x)
+        self.assertTrue(np.array_equal(gate.mask(self.fd), index))
+        # The chunked numpy evaluation must agree with numexpr
+        saved = flowdata.numexpr
+        flowdata.numexpr = None
+        try:
+            self.assertTrue(np.array_equal(gate.mask(self.fd, chunk_events = 300), index))
+        finally:
+            flowdata.numexpr = saved
+        self.assertEqual(gate.apply(self.fd).nevents, np.sum(index))
+        # One sided ranges
+        gate = GateRange('FSC', -np.inf, 50) & GateRange('CD19', 20, np.inf)
+        self.assertTrue(np.array_equal(gate.mask(self.fd), (x <= 50) & (y >= 20)))
+        # 64 bit integer channels
+        counts = (self.data*10).astype(np.uint64)
+        save_uint64(self.path, counts, ['A', 'B', 'C'])
+        gate = GateBound('A', '>', 500) & GateRange('B', 200, np.inf)
+        self.assertTrue(np.array_equal(gate.mask(FlowData(self.path)), (counts[0] > 500) & (counts[1] >= 200)))
+
+        fa = FlowAnalysis()
+        node = fa.append(self.fd)
+        t = GateTree()
+        t.gates = [GateBound('FSC', '>', 50)]
+        node.addChild(t)
+        u = GateTree()
+        u.gates = [GateBound('CD19', '<', 50), GateBound('CD3', '>=', 10)]
+        t.addChild(u)
+        index = (x > 50) & (y < 50) & (z >= 10)
+        self.assertTrue(np.array_equal(u.mask(self.fd), index))
+        self.assertEqual(u.gate(fa.flow_data).nevents, np.sum(index))
+
+    def test_gate_2d(self):
+        (x, y, z) = self.data
+        gate = GateRectangle('FSC', 'CD19', (20, 60), (10, 90))
+        index = (20 <= x) & (x <= 60) & (10 <= y) & (y <= 90)
+        self.assertTrue(np.array_equal(gate.mask(self.fd), index))
+
+        gate = GateEllipse('FSC', 'CD19', (50, 40), (30, 10), np.pi/6)
+        (u, v) = (x - 50, y - 40)
+        index = ((np.cos(np.pi/6)*u + np.sin(np.pi/6)*v)/30)**2 + \
+                ((-np.sin(np.pi/6)*u + np.cos(np.pi/6)*v)/10)**2 <= 1
+        self.assertTrue(np.array_equal(gate.mask(self.fd), index))
+        self.assertRaises(ValueError, GateEllipse, 'FSC', 'CD19', (50, 40), (30, 0))
+
+        gate = GatePolygon('FSC', 'CD19', [(0, 0), (100, 0), (0, 100)])
+        self.assertTrue(np.array_equal(gate.mask(self.fd), x + y < 100))
+
+        # A star with many vertices, against testing every edge
+        t = np.linspace(0, 2*np.pi, 200, endpoint = False)
+        r = 30 + 15*np.sin(7*t)
+        vertices = np.vstack([50 + r*np.cos(t), 50 + r*np.sin(t)]).T
+        index = np.zeros(len(x), dtype = bool)
+        for (a, b) in zip(vertices, np.roll(vertices, -1, axis = 0)):
+            if a[1] != b[1]:
+                index ^= ((a[1] > y) != (b[1] > y)) & (x < a[0] + (y - a[1])*(b[0] - a[0])/(b[1] - a[1]))
+        gate = GatePolygon('FSC', 'CD19', vertices)
+        self.assertTrue(np.array_equal(gate.mask(self.fd), index))
+        gate = gate & GateBound('CD3', '>', 50)
+        self.assertTrue(np.array_equal(gate.mask(self.fd), index & (z > 50)))
+
+    def test_load_many(self):
+        paths = []
+        for j in range(6):
+            paths.append(os.path.join(self.dir, 'file{}.fcs'.format(j)))
+            # Files of different sizes finish loading in different orders
+            fcs.save(paths[-1], self.data[:, :100*(6 - j)] + j, self.metadata, datatype = 'd')
+        fa = FlowAnalysis()
+        fa.load(self.path)
+        fa.load_many(paths, workers = 3)
+        self.assertEqual(len(fa), 7)
+        self.assertEqual(fa.list_files(), ['test.fcs'] + [os.path.basename(p) for p in paths])
+        children = fa.gate_tree.children
+        self.assertEqual([t.title for t in children], fa.list_files())
+        for (j, (fd, t)) in enumerate(zip(fa.flow_data, children)):
+            self.assertEqual(t.gates[0].index, j)
+            self.assertTrue(t.gate(fa.flow_data) is fd)
+        for (j, fd) in enumerate(fa.flow_data[1:]):
+            self.assertEqual(fd.nevents, 100*(6 - j))
+            self.assertTrue(np.array_equal(fd.FSC, self.data[0, :100*(6 - j)] + j))
+
+    def test_gate_masks(self):
+        fa = FlowAnalysis()
+        nodes = [fa.append(self.fd), fa.append(self.fd[self.fd.FSC > 50])]
+        t = GateTree()
+        t.gates = [GateBound('CD19', '<', 50)]
+        fa.gate_tree.addChild(t)
+        u = GateTree()
+        u.gates = [GateBound('CD3', '>', 25)]
+        nodes[0].addChild(u)
+        masks = fa.gate_masks(workers = 2)
+        (x, y, z) = self.data
+        self.assertEqual(len(masks), 2 + 2 + 2 + 1)
+        self.assertTrue(masks[(nodes[0], 0)].all())
+        self.assertFalse((nodes[0], 1) in masks)
+        self.assertTrue(np.array_equal(masks[(t, 0)], y < 50))
+        self.assertTrue(np.array_equal(masks[(t, 1)], y[x > 50] < 50))
+        self.assertTrue(np.array_equal(masks[(u, 0)], z > 25))
+        self.assertFalse((u, 1) in masks)
+
+    def test_statistics(self):
+        fa = FlowAnalysis()
+        node = fa.append(self.fd)
+        t = GateTree()
+        t.gates = [GateBound('FSC', '>', 50)]
+        t.title = 'FSC+'
+        node.addChild(t)
+        table = fa.gate_tree.statistics(fa, ['CD19', 'Er167'], ('count', 'frequency', 'median', 'mean'))
+        self.assertEqual(list(table['title']), ['All Data', 'Appended item 0', 'FSC+'])
+        (x, y, z) = self.data
+        index = x > 50
+        row = table[2]
+        self.assertTrue(row['node'] is t)
+        self.assertEqual(row['count'], np.sum(index))
+        self.assertAlmostEqual(row['frequency'], 100.*np.sum(index)/len(x))
+        self.assertAlmostEqual(row['median CD19'], np.median(y[index]))
+        self.assertAlmostEqual(row['median Er167'], np.median(z[index]))
+        self.assertAlmostEqual(row['mean CD19'], np.mean(y[index]))
+        self.assertAlmostEqual(table[0]['median CD19'], np.median(y))
+        self.assertRaises(ValueError, t.statistics, fa, stats = ('mode',))
+
+        # Medians of large populations come from quantile sketches
+        table = fa.gate_tree.statistics(fa, ['CD19'], ('median', 'mean'), approximate = 100)
+        self.assertEqual(len(table), 3)
+        self.assertEqual(table[0]['median CD19'], self.fd.quantile('CD19', 0.5))
+        self.assertTrue(abs(np.mean(y[index] <= table[2]['median CD19']) - 0.5) < 0.02)
+        self.assertAlmostEqual(table[2]['mean CD19'], np.mean(y[index]))
+
+    def test_quantile(self):
+        self.assertTrue(self.fd.sketch('CD19') is self.fd.sketch('Nd142'))
+        (low, median, high) = self.fd.quantile('CD19', [0, 0.5, 1])
+        self.assertEqual(low, np.min(self.data[1]))
+        self.assertEqual(high, np.max(self.data[1]))
+        self.assertTrue(abs(np.mean(self.data[1] <= median) - 0.5) < 0.02)
+
+    def test_dtype(self):
+        self.assertEqual(self.fd.data.dtype, np.float64)
+        fd = FlowData(self.path, dtype = np.float32)
+        self.assertEqual(fd.data.dtype, np.float32)
+        self.assertEqual(fd[fd.FSC > 50].CD19.dtype, np.float32)
+        fd = FlowData(self.path, mmap = True, dtype = np.float32)
+        self.assertEqual(fd[fd.FSC > 50].data.dtype, np.float32)
+        self.assertTrue(np.allclose(fd.CD19, self.data[1]))
+        (xgrid, den) = fd.kde1('CD19', 5.)
+        self.assertTrue(np.allclose(den, self.fd.kde1('CD19', 5.)[1]))
+        self.assertEqual(FlowData(self.path, mmap = True, dtype = np.float32).CD3.dtype, np.float32)
+        # CyTOF data is stored in single precision by default
+        self.metadata['$CYT'] = 'Helios'
+        fcs.save(self.path, self.data, self.metadata, datatype = 'd')
+        self.assertEqual(FlowData(self.path).data.dtype, np.float32)
+
+    def test_summary(self):
+        self.data[1, :10] = 0
+        fcs.save(self.path, self.data, self.metadata, datatype = 'd')
+        for fd in [FlowData(self.path), FlowData(self.path, mmap = True)]:
+            summary = fd.summary('CD19')
+            x = self.data[1]
+            self.assertEqual(summary.count, 1000)
+            self.assertEqual(summary.min, np.min(x))
+            self.assertEqual(summary.max, np.max(x))
+            self.assertAlmostEqual(summary.sum, np.sum(x))
+            self.assertAlmostEqual(summary.sumsq, np.sum(x**2))
+            self.assertEqual(summary.zeros, 10)
+        daughter = fd[fd.FSC > 50]
+        x = x[self.data[0] > 50]
+        self.assertEqual(daughter.summary('CD19').max, np.max(x))
+        self.assertEqual(daughter.summary('CD19').count, len(x))
+        # Every channel of an in-memory daughter is summarized at once
+        daughter = self.fd[self.fd.FSC > 50]
+        self.assertEqual(daughter.summary('CD19').max, np.max(x))
+        self.assertEqual(sorted(daughter._summaries), [0, 1, 2])
+        self.assertAlmostEqual(daughter.summary('CD3').sum, np.sum(self.data[2, self.data[0] > 50]))
+        self.assertTrue(self.fd[self.fd.FSC >= 0]._summaries is self.fd._summaries)
+
+    def test_kde1_batch(self):
+        masks = [self.fd.FSC > 50, self.fd.CD3 < 30]
+        (xgrids, den) = self.fd.kde1_batch(['CD19', 'CD3'], masks, bandwidth = 2., npoints = 101)
+        self.assertEqual(den.shape, (2, 2, 101))
+        for (i, channel) in enumerate(['CD19', 'CD3']):
+            for (j, mask) in enumerate(masks):
+                # Densities of a daughter use the grid of the daughter, so
+                # compare with the hat kernel on the same grid
+                x = self.fd.get(channel)[mask]
+                ref = kde.hat_linear(x, 2., xgrids[i][0], xgrids[i][-1], 101)*len(x)/1000.
+                self.assertTrue(np.allclose(den[i, j], ref))
+        # Populations of a daughter, on transformed channels
+        fd = self.fd[self.fd.FSC > 50]
+        (xgrids, den) = fd.kde1_batch(['CD19'], [fd.CD3 < 30], 0.1, 101, ('arcsinh', 5))
+        x = fd.transform('CD19', 'arcsinh', 5)[fd.CD3 < 30]
+        ref = kde.hat_linear(x, 0.1, xgrids[0][0], xgrids[0][-1], 101)*len(x)/1000.
+        self.assertTrue(np.allclose(den[0, 0], ref))
+        (xgrids, den) = fd.kde1_batch(['CD19'], [fd.CD3 < 30], 2., 101)
+        ref = kde.hat_linear(fd.CD19[fd.CD3 < 30], 2., xgrids[0][0], xgrids[0][-1], 101)*np.sum(fd.CD3 < 30)/1000.
+        self.assertTrue(np.allclose(den[0, 0], ref))
+        # An empty daughter has no range to grid, as for kde1
+        empty = self.fd[self.fd.FSC > np.inf]
+        self.assertRaises(ValueError, empty.kde1_batch, ['CD19'])
+        self.assertRaises(ValueError, empty.kde1, 'CD19')
+
+    def test_kde2(self):
+        (xgrid, ygrid, den) = self.fd.kde2('CD19', 'CD3', (10., 5.), npoints = (51, 41))
+        self.assertEqual(den.shape, (51, 41))
+        self.assertEqual(xgrid[-1], np.max(self.data[1]))
+        self.assertEqual(ygrid[0], np.min(self.data[2]))
+        ref = kde.kernel2_linear(self.data[1], self.data[2], 'hat', (10., 5.), npoints = (51, 41))
+        self.assertTrue(np.allclose(den, ref))
+        (xgrid, ygrid, den2) = self.fd.kde2('CD19', 'CD3', (10., 5.), npoints = (51, 41), method = 'direct')
+        self.assertTrue(np.allclose(den, den2))
+        # A daughter is scaled by its share of the events
+        fd = self.fd[self.fd.FSC > 50]
+        (xgrid, ygrid, den) = fd.kde2('CD19', 'CD3', (0.2, 0.2), 'gaussian', (51, 51), ('arcsinh', 5),
+                method = 'direct')
+        ref = kde.kernel2_linear(fd.transform('CD19', 'arcsinh', 5), fd.transform('CD3', 'arcsinh', 5),
+                'gaussian', (0.2, 0.2), xgrid[0], xgrid[-1], ygrid[0], ygrid[-1], (51, 51))
+        self.assertTrue(np.allclose(den, ref*fd.nevents/1000.))
+        (xgrid, ygrid, den2) = fd.kde2('CD19', 'CD3', (0.2, 0.2), 'gaussian', (51, 51), ('arcsinh', 5),
+                method = 'binned')
+        self.assertLess(np.max(np.abs(den2 - den)), 0.05*np.max(den))
+        self.assertRaises(ValueError, self.fd.kde2, 'CD19', 'CD3', kernel = 'triweight')
+        self.assertRaises(ValueError, self.fd.kde2, 'CD19', 'CD3', npoints = (1, 51))
+
+
+if __name__ == '__main__':
+    unittest.main()
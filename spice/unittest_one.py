@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import fcs
+from flowdata import FlowAnalysis
+
+try:
+    import one
+except ImportError:
+    # The viewer needs wx and matplotlib
+    one = None
+
+class _Frame:
+    """ Stands in for a OneFrame, recording the calls load_many makes."""
+    def __init__(self):
+        self.fa = FlowAnalysis()
+        self.calls = []
+        self.tree = self
+    def update(self):
+        self.calls.append('tree')
+    def update_tag_list(self):
+        self.calls.append('tags')
+
+@unittest.skipIf(one is None, 'wx and matplotlib are not installed')
+class TestOneFrame(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.paths = [os.path.join(self.dir, 'file{}.fcs'.format(j)) for j in range(4)]
+        for (j, path) in enumerate(self.paths):
+            fcs.save(path, np.random.rand(2, 50*(j + 1)), {'$P1N': 'FSC', '$P2N': 'SSC'})
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_load_many(self):
+        frame = _Frame()
+        one.OneFrame.load_many.im_func(frame, self.paths)
+        self.assertEqual(frame.fa.list_files(), [os.path.basename(p) for p in self.paths])
+        self.assertEqual([t.title for t in frame.fa.gate_tree.children], frame.fa.list_files())
+        self.assertEqual([fd.nevents for fd in frame.fa.flow_data], [50, 100, 150, 200])
+        # The tree and tag list are refreshed once, showing the last file
+        self.assertEqual(frame.calls, ['tree', 'tags'])
+        self.assertEqual(frame.index, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
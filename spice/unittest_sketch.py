@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import fcs
+import sketch
+
+class TestSketch(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(1)
+        self.x = np.random.randn(200000)
+
+    def assertQuantiles(self, s, x, tol = 0.01):
+        q = np.linspace(0, 1, 21)
+        # Compare ranks, since that is what the sketch bounds
+        ranks = np.searchsorted(np.sort(x), s.quantile(q))/float(len(x))
+        self.assertTrue(np.max(np.abs(ranks - q)) < tol)
+
+    def test_update(self):
+        s = sketch.KLL(seed = 2).update(self.x[:100000]).update(self.x[100000:], chunk = 3000)
+        self.assertEqual(len(s), len(self.x))
+        self.assertEqual(s.quantile(0), np.min(self.x))
+        self.assertEqual(s.quantile(1), np.max(self.x))
+        self.assertQuantiles(s, self.x)
+        self.assertTrue(abs(s.rank(0.) - np.mean(self.x <= 0)) < 0.01)
+        # The sketch stays small
+        self.assertTrue(sum(len(v) for v in s._levels) < 1000)
+
+    def test_small(self):
+        s = sketch.KLL().update([3., 1., np.nan, 2.])
+        self.assertEqual(len(s), 3)
+        self.assertEqual(s.quantile(0.5), 2.)
+        self.assertRaises(ValueError, sketch.KLL().quantile, 0.5)
+
+    def test_merge(self):
+        parts = [sketch.KLL(seed = j).update(x) for (j, x) in enumerate(np.split(self.x, 8))]
+        s = sketch.merge(parts)
+        self.assertEqual(len(s), len(self.x))
+        self.assertQuantiles(s, self.x)
+
+    def test_sketch_file(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'test.fcs')
+            data = np.vstack([self.x, np.exp(self.x)]).astype(np.float32)
+            fcs.save(path, data, {'$P1N': 'a', '$P2N': 'b'})
+            sketches = sketch.sketch_file(path, chunk_events = 30000, seed = 3)
+            self.assertEqual(len(sketches), 2)
+            self.assertQuantiles(sketches[1], data[1])
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()